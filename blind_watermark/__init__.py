@@ -1,5 +1,8 @@
 from .blind_watermark import WaterMark
-from .bwm_core import WaterMarkCore
+from .bwm_core import WaterMarkCore, WatermarkParams, embed_array, extract_array, extract_llr, extract_progressive
+from .cache import HostCache
+from .plan import default_plan_cache
+from .pool import PoolManager, default_pool_manager, limit_threads, thread_limits
 from .att import *
 from .recover import recover_crop
 from .version import __version__, bw_notes
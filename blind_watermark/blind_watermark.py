@@ -7,15 +7,23 @@ import warnings
 import numpy as np
 import cv2
 
-from .bwm_core import WaterMarkCore
+from .bwm_core import WaterMarkCore, one_dim_kmeans
+from .img_io import read_img_file, write_img_file, create_img_file
+from .pipeline import run_pipeline
 from .version import bw_notes
 
 
 class WaterMark:
-    def __init__(self, password_wm=1, password_img=1, block_shape=(4, 4), mode='common', processes=None):
+    def __init__(self, password_wm=1, password_img=1, block_shape=(4, 4), mode='common', processes=None,
+                 channels=(0, 1, 2), cache=None, plan_dir=None, shuffle_version=1, pool_manager=None,
+                 executor=None, chunk_size=None, cores_per_job=None, dwt_level=1, redundancy=None):
         bw_notes.print_notes()
 
-        self.bwm_core = WaterMarkCore(password_img=password_img, mode=mode, processes=processes)
+        self.bwm_core = WaterMarkCore(password_img=password_img, mode=mode, processes=processes, channels=channels,
+                                      cache=cache, plan_dir=plan_dir, shuffle_version=shuffle_version,
+                                      pool_manager=pool_manager, executor=executor, chunk_size=chunk_size,
+                                      cores_per_job=cores_per_job, block_shape=block_shape, dwt_level=dwt_level,
+                                      redundancy=redundancy)
 
         self.password_wm = password_wm
 
@@ -24,34 +32,37 @@ class WaterMark:
 
     def read_img(self, filename=None, img=None):
         if img is None:
-            # 从文件读入图片
-            img = cv2.imread(filename, flags=cv2.IMREAD_UNCHANGED)
+            # 从文件读入图片，.npy 文件以 memmap 方式打开
+            img = read_img_file(filename, flags=cv2.IMREAD_UNCHANGED)
             assert img is not None, "image file '{filename}' not read".format(filename=filename)
 
         self.bwm_core.read_img_arr(img=img)
         return img
 
     def read_wm(self, wm_content, mode='img'):
+        self.wm_bit = self.encode_wm(wm_content, mode=mode)
+        self.wm_size = self.wm_bit.size
+        self.bwm_core.read_wm(self.wm_bit)
+
+    def encode_wm(self, wm_content, mode='img'):
+        # 把水印转为一维 bit 格式并用 password_wm 加密，不改动 self 上的状态
         assert mode in ('img', 'str', 'bit'), "mode in ('img','str','bit')"
         if mode == 'img':
             wm = cv2.imread(filename=wm_content, flags=cv2.IMREAD_GRAYSCALE)
             assert wm is not None, 'file "{filename}" not read'.format(filename=wm_content)
 
             # 读入图片格式的水印，并转为一维 bit 格式，抛弃灰度级别
-            self.wm_bit = wm.flatten() > 128
+            wm_bit = wm.flatten() > 128
 
         elif mode == 'str':
             byte = bin(int(wm_content.encode('utf-8').hex(), base=16))[2:]
-            self.wm_bit = (np.array(list(byte)) == '1')
+            wm_bit = (np.array(list(byte)) == '1')
         else:
-            self.wm_bit = np.array(wm_content)
-
-        self.wm_size = self.wm_bit.size
+            wm_bit = np.array(wm_content)
 
         # 水印加密:
-        np.random.RandomState(self.password_wm).shuffle(self.wm_bit)
-
-        self.bwm_core.read_wm(self.wm_bit)
+        np.random.RandomState(self.password_wm).shuffle(wm_bit)
+        return wm_bit
 
     def embed(self, filename=None, compression_ratio=None):
         '''
@@ -64,45 +75,199 @@ class WaterMark:
         '''
         embed_img = self.bwm_core.embed()
         if filename is not None:
-            if compression_ratio is None:
-                cv2.imwrite(filename=filename, img=embed_img)
-            elif filename.endswith('.jpg'):
-                cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_JPEG_QUALITY, compression_ratio])
-            elif filename.endswith('.png'):
-                cv2.imwrite(filename=filename, img=embed_img, params=[cv2.IMWRITE_PNG_COMPRESSION, compression_ratio])
-            else:
-                cv2.imwrite(filename=filename, img=embed_img)
+            save_img(filename, embed_img, compression_ratio)
         return embed_img
 
+    def embed_batch(self, jobs, mode='str', compression_ratio=None, decoders=2, workers=1, encoders=2, queue_size=8):
+        '''
+        Embed watermarks into many image files with a three-stage pipeline:
+        `decoders` threads read images, `workers` threads embed, `encoders` threads write the results.
+        The stages overlap, and bounded queues of `queue_size` make a fast stage wait for a slow one,
+        so memory stays bounded however many jobs there are.
+        :param jobs: iterable of `(src, dst)` or `(src, dst, wm_content)`.
+            `(src, dst)` uses the watermark read by `read_wm`, `wm_content` is what `read_wm` accepts with `mode`
+        :param mode: 'img', 'str' or 'bit', the same as `read_wm`
+        :param compression_ratio: the same as `embed`
+        :return: list of `(job, exception)` for the jobs that failed, the other jobs are not affected
+        '''
+
+        def decode(job):
+            img = read_img_file(job[0], flags=cv2.IMREAD_UNCHANGED)
+            assert img is not None, "image file '{filename}' not read".format(filename=job[0])
+            return img
+
+        def compute(job, img):
+            wm_bit = self.encode_wm(job[2], mode=mode) if len(job) > 2 else self.wm_bit
+            return self.bwm_core.embed_img(img, wm_bit)
+
+        def encode(job, embed_img):
+            save_img(job[1], embed_img, compression_ratio)
+
+        return run_pipeline(jobs, decode, compute, encode,
+                            decoders=decoders, workers=workers, encoders=encoders, queue_size=queue_size)
+
+    def embed_tiled(self, src, dst, strip_height=1024):
+        '''
+        Embed the watermark read by `read_wm` into a large image strip by strip, `read_img` is not needed.
+        Only about `strip_height` rows are in memory at a time, the result is the same as `mode='vectorization'`.
+        :param src: uint8 array of shape (H, W, 3) or (H, W, 4) that can be sliced by rows, e.g. `np.memmap`,
+            or a '.npy' filename, which is opened as a read-only memmap
+        :param dst: writable array of the same shape, e.g. `np.memmap`, or a '.npy' filename to create
+        :param strip_height: number of pixel rows processed at a time
+        :return: dst
+        '''
+        if isinstance(src, str):
+            src = read_img_file(src)
+        if isinstance(dst, str):
+            dst = create_img_file(dst, src.shape, src.dtype)
+        self.bwm_core.embed_tiled(src, dst, strip_height=strip_height)
+        if isinstance(dst, np.memmap):
+            dst.flush()
+        return dst
+
+    def embed_many(self, wm_contents, mode='str', filename=None, img=None, callback=None):
+        '''
+        Embed many watermarks into the same image, e.g. one per recipient.
+        The image is decomposed only once, each watermark only re-quantizes the singular values.
+        :param wm_contents: iterable of watermarks, each one is what `read_wm` accepts
+        :param mode: 'img', 'str' or 'bit', the same as `read_wm`
+        :param filename, img: the image, the same as `read_img`. If both are None, use the image already read
+        :param callback: None or function. If None, return a generator of embedded images,
+            otherwise call `callback(i, embed_img)` for every watermark and return None
+        '''
+        if filename is not None or img is not None:
+            self.read_img(filename=filename, img=img)
+
+        def wm_bits():
+            for wm_content in wm_contents:
+                self.read_wm(wm_content, mode=mode)
+                yield self.wm_bit
+
+        embed_imgs = self.bwm_core.embed_many(wm_bits())
+        if callback is None:
+            return embed_imgs
+        for i, embed_img in enumerate(embed_imgs):
+            callback(i, embed_img)
+
     def extract_decrypt(self, wm_avg):
-        wm_index = np.arange(self.wm_size)
+        wm_index = np.arange(wm_avg.size)
         np.random.RandomState(self.password_wm).shuffle(wm_index)
         wm_avg[wm_index] = wm_avg.copy()
         return wm_avg
 
     def extract(self, filename=None, embed_img=None, wm_shape=None, out_wm_name=None, mode='img'):
+        '''
+        Extract the watermark. The state of this object is not changed, so one instance can be shared by many threads.
+        :param filename, embed_img: the image with watermark, the same as `read_img`
+        :param wm_shape: shape of the watermark image for mode='img', or number of bits for mode='str' and 'bit'
+        :param out_wm_name: filename to save the extracted watermark image, only for mode='img'
+        :param mode: 'img', 'str' or 'bit', the same as `read_wm`
+        :return:
+        '''
         assert wm_shape is not None, 'wm_shape needed'
 
         if filename is not None:
-            embed_img = cv2.imread(filename, flags=cv2.IMREAD_COLOR)
+            # .npy 文件以 memmap 方式打开，分条带提取，不整个读入内存
+            embed_img = read_img_file(filename, flags=cv2.IMREAD_COLOR)
             assert embed_img is not None, "{filename} not read".format(filename=filename)
 
-        self.wm_size = np.array(wm_shape).prod()
-
         if mode in ('str', 'bit'):
-            wm_avg = self.bwm_core.extract_with_kmeans(img=embed_img, wm_shape=wm_shape)
+            # 软判决：每一位的 LLR 大于 0 判为 1
+            wm_avg = self.bwm_core.extract_llr(img=embed_img, wm_shape=wm_shape) > 0
         else:
             wm_avg = self.bwm_core.extract(img=embed_img, wm_shape=wm_shape)
 
+        wm = self.decode_wm(wm_avg, wm_shape, mode)
+        if mode == 'img':
+            cv2.imwrite(out_wm_name, wm)
+        return wm
+
+    def extract_progressive(self, filename=None, embed_img=None, wm_shape=None, mode='bit', confidence=0.999,
+                            max_ms=None):
+        '''
+        Extract the watermark progressively, for interactive lookups.
+        Blocks are visited in rounds, every round reads one more copy of every bit, and the rounds are spread over
+        the image in an order set by `password_img`. Extraction stops as soon as every bit reaches `confidence`,
+        or after `max_ms` milliseconds. Clean images usually decode from a small fraction of the blocks.
+        :param filename, embed_img, wm_shape, mode: the same as `extract`. For mode='img' the watermark image is returned, not saved
+        :param confidence: stop when the confidence of every bit is at least this
+        :param max_ms: None or time budget in milliseconds, the bits decoded so far are returned when it runs out
+        :return: (wm, wm_confidence). wm_confidence[i] is the confidence of the i-th bit, in [0, 1].
+            It is a Hoeffding bound on the probability that the average of the votes of the bit is on the wrong side of 0.5
+        '''
+        assert wm_shape is not None, 'wm_shape needed'
+        if filename is not None:
+            embed_img = read_img_file(filename, flags=cv2.IMREAD_COLOR)
+            assert embed_img is not None, "{filename} not read".format(filename=filename)
+
+        wm_avg, wm_confidence = self.bwm_core.extract_progressive(embed_img, wm_shape, confidence=confidence,
+                                                                  max_ms=max_ms)
+        if mode in ('str', 'bit'):
+            # 投票只有硬判决，用 one_dim_kmeans 的阈值判决，投票整体偏向 0 或 1 时也能分开
+            wm_avg = one_dim_kmeans(wm_avg)
+        return self.decode_wm(wm_avg, wm_shape, mode), self.extract_decrypt(wm_confidence)
+
+    def extract_llr(self, filename=None, embed_img=None, wm_shape=None):
+        '''
+        Extract the log-likelihood ratio of every bit, for soft-decision decoding downstream, e.g. an error-correcting code.
+        Every block gives a soft value for each singular value it carries, by how far `s mod d` is from the decision boundary.
+        The channels and singular values are weighted by their measured reliability.
+        :param filename, embed_img, wm_shape: the same as `extract`
+        :return: array of `prod(wm_shape)` floats in the order of the watermark bits. Positive means 1, a larger absolute value is more reliable
+        '''
+        assert wm_shape is not None, 'wm_shape needed'
+        if filename is not None:
+            embed_img = read_img_file(filename, flags=cv2.IMREAD_COLOR)
+            assert embed_img is not None, "{filename} not read".format(filename=filename)
+        return self.extract_decrypt(self.bwm_core.extract_llr(img=embed_img, wm_shape=wm_shape))
+
+    def decode_wm(self, wm_avg, wm_shape, mode='img'):
         # 解密：
         wm = self.extract_decrypt(wm_avg=wm_avg)
 
         # 转化为指定格式：
         if mode == 'img':
             wm = 255 * wm.reshape(wm_shape[0], wm_shape[1])
-            cv2.imwrite(out_wm_name, wm)
         elif mode == 'str':
             byte = ''.join(str((i >= 0.5) * 1) for i in wm)
             wm = bytes.fromhex(hex(int(byte, base=2))[2:]).decode('utf-8', errors='replace')
 
         return wm
+
+    def extract_many(self, images, wm_shape, mode='img', batch_size=64):
+        '''
+        Extract the watermark from many images, e.g. a crawl of suspected leaks.
+        Images of the same shape are stacked into batches and extracted together with one shared plan,
+        which is much faster than calling `extract` on every small image. The result is the same as `mode='vectorization'`.
+        :param images: iterable of filenames or image arrays, read one by one
+        :param wm_shape: the same as `extract`, all images must carry a watermark of this shape
+        :param mode: 'img', 'str' or 'bit'. For 'img' the watermark images are returned, not saved
+        :param batch_size: at most this many images of the same shape are extracted at once
+        :return: list of watermarks, in the order of `images`
+        '''
+
+        def read_images():
+            for image in images:
+                if isinstance(image, str):
+                    filename, image = image, read_img_file(image, flags=cv2.IMREAD_COLOR)
+                    assert image is not None, "{filename} not read".format(filename=filename)
+                yield image
+
+        wms = {}
+        soft = mode in ('str', 'bit')
+        for i, wm_avg in self.bwm_core.extract_many(read_images(), wm_shape, batch_size=batch_size, soft=soft):
+            if soft:
+                wm_avg = wm_avg > 0
+            wms[i] = self.decode_wm(wm_avg, wm_shape, mode)
+        return [wms[i] for i in range(len(wms))]
+
+
+def save_img(filename, embed_img, compression_ratio=None):
+    if compression_ratio is None:
+        write_img_file(filename, embed_img)
+    elif filename.endswith('.jpg'):
+        write_img_file(filename, embed_img, params=[cv2.IMWRITE_JPEG_QUALITY, compression_ratio])
+    elif filename.endswith('.png'):
+        write_img_file(filename, embed_img, params=[cv2.IMWRITE_PNG_COMPRESSION, compression_ratio])
+    else:
+        write_img_file(filename, embed_img)
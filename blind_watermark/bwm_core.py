@@ -2,69 +2,148 @@
 # coding=utf-8
 # @Time    : 2021/12/17
 # @Author  : github.com/guofei9987
+import time
+from collections import namedtuple
+from functools import wraps
+
 import numpy as np
 from numpy.linalg import svd
-import copy
 import cv2
 from cv2 import dct, idct
 from pywt import dwt2, idwt2
-from .pool import AutoPool
+from .pool import AutoPool, SharedArray
+from .transform import BlockTransform, get_block_transform, tile_view
+from .cache import content_hash, default_host_cache
+from .decision import soft_margin, otsu_threshold, bit_stats, bit_llr
+from .plan import get_plan, row_slice, visit_rounds, ShuffleStream, random_strategy1, random_strategy2, random_strategy3
+
+
+class WatermarkParams(namedtuple('WatermarkParams', ['password_img', 'd1', 'd2', 'fast_mode', 'channels',
+                                                     'shuffle_version', 'block_shape', 'dwt_level', 'redundancy'])):
+    '''
+    不可变的嵌入/提取参数，嵌入和提取时要一致。可哈希、可 pickle，多个线程可以共用同一个。
+    d1/d2 越大鲁棒性越强,但输出图片的失真越大；channels 是嵌入水印的 YUV 通道；
+    shuffle_version 对应 random_strategy1/2/3；block_shape 是 LL 子带上每个分块的大小，例如 (4, 4)、(8, 8)、(4, 8)；
+    dwt_level 是 haar 小波的层数，在第 dwt_level 层的 LL 子带上分块，每多一层分块数少为 1/4；
+    redundancy 不为 None 时每一位最多嵌入这么多次，只用由 password_img 选出的部分分块
+    '''
+    __slots__ = ()
+
+    def __new__(cls, password_img=1, d1=36, d2=20, fast_mode=False, channels=(0, 1, 2), shuffle_version=1,
+                block_shape=(4, 4), dwt_level=1, redundancy=None):
+        channels = tuple(sorted(set(channels)))
+        assert len(channels) > 0 and set(channels) <= {0, 1, 2}, 'channels should be a subset of (0, 1, 2)'
+        assert shuffle_version in (1, 2, 3), 'shuffle_version should be 1, 2 or 3'
+        return super().__new__(cls, password_img, d1, d2, fast_mode, channels, shuffle_version,
+                               check_block_shape(block_shape), check_dwt_level(dwt_level),
+                               check_redundancy(redundancy))
+
+    @property
+    def transform(self):
+        return get_block_transform(self.block_shape, dwt_level=self.dwt_level)
+
+    def get_plan(self, img_shape, wm_size, plan_dir=None):
+        # img_shape 是原图的高、宽
+        grid_shape = get_grid_shape(img_shape, self.transform.tile_shape)
+        check_capacity(grid_shape[0] * grid_shape[1], wm_size)
+        return get_plan(grid_shape, self.block_shape, self.password_img, int(wm_size),
+                        shuffle_version=self.shuffle_version, plan_dir=plan_dir, redundancy=self.redundancy)
+
+
+# 读入后的原图：img 是 float32 的 BGR 图，img_YUV 对像素做了加白偶数化，只含用到的通道，alpha 是透明通道或 None
+HostImage = namedtuple('HostImage', ['img', 'img_YUV', 'alpha'])
+
+
+def with_thread_limits(method):
+    # 嵌入/提取期间按 cores_per_job 限制 OpenCV/BLAS 的线程数，返回时恢复，见 AutoPool.thread_limits
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.pool.thread_limits():
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class WaterMarkCore:
-    def __init__(self, password_img=1, mode='common', processes=None):
-        self.block_shape = np.array([4, 4])
+    def __init__(self, password_img=1, mode='common', processes=None, channels=(0, 1, 2), cache=None,
+                 plan_dir=None, shuffle_version=1, pool_manager=None, executor=None, chunk_size=None,
+                 cores_per_job=None, block_shape=(4, 4), dwt_level=1, redundancy=None):
+        self.block_shape = np.array(check_block_shape(block_shape))
+        self.dwt_level = check_dwt_level(dwt_level)  # 在第几层 haar 小波的 LL 子带上嵌入
+        # 每一位最多嵌入几次，None 表示用上全部分块。不为 None 时只处理由 password_img 选出的分块，其余分块不改动
+        self.redundancy = check_redundancy(redundancy)
         self.password_img = password_img
         self.d1, self.d2 = 36, 20  # d1/d2 越大鲁棒性越强,但输出图片的失真越大
 
+        # 嵌入水印的 YUV 通道，0/1/2 分别是 Y/U/V。例如 (0,) 只用亮度，其它通道不做任何计算
+        self.channels = tuple(sorted(set(channels)))
+        assert len(self.channels) > 0 and set(self.channels) <= {0, 1, 2}, 'channels should be a subset of (0, 1, 2)'
+        channel_num = len(self.channels)
+
         # init data
-        self.img, self.img_YUV = None, None  # self.img 是原图，self.img_YUV 对像素做了加白偶数化
-        self.ca, self.hvd, = [np.array([])] * 3, [np.array([])] * 3  # 每个通道 dct 的结果
-        self.ca_block = [np.array([])] * 3  # 每个 channel 存一个四维 array，代表四维分块后的结果
-        self.ca_part = [np.array([])] * 3  # 四维分块后，有时因不整除而少一部分，self.ca_part 是少这一部分的 self.ca
+        self.host = None  # read_img_arr 的结果 HostImage
+        self.img, self.img_YUV = None, None  # self.img 是原图，self.img_YUV 对像素做了加白偶数化，只含 self.channels 这几个通道
+        # 每个通道 dwt 的结果，float32。self.ca 是最后一层的 LL，self.hvd 是每一层的 (hvd, 该层输入的形状)
+        self.ca, self.hvd, = [np.array([])] * channel_num, [[]] * channel_num
+        self.ca_block = [np.array([])] * channel_num  # 每个 channel 存一个四维 array，是 self.ca 四维分块后的视图，不复制数据
 
         self.wm_size, self.block_num = 0, 0  # 水印的长度，原图片可插入信息的个数
-        self.pool = AutoPool(mode=mode, processes=processes)
+        self.pool = AutoPool(mode=mode, processes=processes, pool_manager=pool_manager, executor=executor,
+                             chunk_size=chunk_size, cores_per_job=cores_per_job)
 
         self.fast_mode = False
         self.alpha = None  # 用于处理透明图
 
+        # 除 common 外的模式，都直接从 block_shape * 2 ** dwt_level 的像素分块算出 LL 子带分块的 dct 系数，不做整图的 dwt2/idwt2
+        # multithreading/multiprocessing/executor 把 img_YUV 放进共享内存，每个任务处理其中连续的若干行分块
+        self.vec_mode = self.pool.mode in ('vectorization', 'cached') or self.pool.banded
+        self.transform = BlockTransform(self.block_shape, dwt_level=self.dwt_level)
+
+        # cached 模式下，原图每个分块的 svd 结果存入 cache，同一张图再嵌入别的水印时直接复用
+        self.cache = cache if cache is not None else default_host_cache
+        self.img_key = None
+
+        # 分块索引和打乱顺序由 get_plan 生成并缓存，plan_dir 不为 None 时还会存到磁盘上
+        # shuffle_version 对应 random_strategy1/2/3，嵌入和提取时要一致。默认 1 与旧版本兼容，3 生成得更快
+        self.plan, self.plan_dir = None, plan_dir
+        assert shuffle_version in (1, 2, 3), 'shuffle_version should be 1, 2 or 3'
+        self.shuffle_version = shuffle_version
+
+    @property
+    def params(self):
+        # 当前参数的不可变快照，d1/d2/fast_mode 等属性可以在嵌入前修改
+        return WatermarkParams(password_img=self.password_img, d1=self.d1, d2=self.d2, fast_mode=self.fast_mode,
+                               channels=self.channels, shuffle_version=self.shuffle_version,
+                               block_shape=tuple(self.block_shape), dwt_level=self.dwt_level,
+                               redundancy=self.redundancy)
+
     def init_block_index(self):
-        self.block_num = self.ca_block_shape[0] * self.ca_block_shape[1]
-        assert self.wm_size < self.block_num, IndexError(
-            '最多可嵌入{}kb信息，多于水印的{}kb信息，溢出'.format(self.block_num / 1000, self.wm_size / 1000))
-        # self.part_shape 是取整后的ca二维大小,用于嵌入时忽略右边和下面对不齐的细条部分。
-        self.part_shape = self.ca_block_shape[:2] * self.block_shape
-        self.block_index = [(i, j) for i in range(self.ca_block_shape[0]) for j in range(self.ca_block_shape[1])]
+        check_capacity(self.ca_block_shape[0] * self.ca_block_shape[1], self.wm_size)
+        self.plan = get_plan(self.ca_block_shape[:2], tuple(self.block_shape), self.password_img, self.wm_size,
+                             shuffle_version=self.shuffle_version, plan_dir=self.plan_dir, redundancy=self.redundancy)
+        self.block_num = self.plan.block_num  # 嵌入水印的分块数，redundancy 不为 None 时可能少于全部分块
+        self.block_index = self.plan.block_index
+        self.idx_shuffle = self.plan.idx_shuffle
 
     def read_img_arr(self, img):
-        # 处理透明图
-        self.alpha = None
-        if img.shape[2] == 4:
-            if img[:, :, 3].min() < 255:
-                self.alpha = img[:, :, 3]
-                img = img[:, :, :3]
-
-        # 读入图片->YUV化->加白边使像素变偶数->四维分块
-        self.img = img.astype(np.float32)
+        # 处理透明图，读入图片->YUV化->加白边使像素变偶数->四维分块
+        self.host = prepare_img(img, self.channels)
+        self.img, self.img_YUV, self.alpha = self.host
         self.img_shape = self.img.shape[:2]
 
-        # 如果不是偶数，那么补上白边，Y（明亮度）UV（颜色）
-        self.img_YUV = cv2.copyMakeBorder(cv2.cvtColor(self.img, cv2.COLOR_BGR2YUV),
-                                          0, self.img.shape[0] % 2, 0, self.img.shape[1] % 2,
-                                          cv2.BORDER_CONSTANT, value=(0, 0, 0))
-
-        self.ca_shape = [(i + 1) // 2 for i in self.img_shape]
+        # 只用完整落在图内的分块，dwt_level > 1 时 LL 最右、最下可能有用到补边的系数，不在分块内
+        self.ca_block_shape = get_grid_shape(self.img_shape, self.transform.tile_shape) + tuple(self.block_shape)
 
-        self.ca_block_shape = (self.ca_shape[0] // self.block_shape[0], self.ca_shape[1] // self.block_shape[1],
-                               self.block_shape[0], self.block_shape[1])
-        strides = 4 * np.array([self.ca_shape[1] * self.block_shape[0], self.block_shape[1], self.ca_shape[1], 1])
+        if self.vec_mode:
+            # 分块变换直接作用于 self.img_YUV，不需要 ca/hvd
+            if self.pool.mode == 'cached':
+                self.img_key = content_hash(img)
+            return
 
-        for channel in range(3):
-            self.ca[channel], self.hvd[channel] = dwt2(self.img_YUV[:, :, channel], 'haar')
+        for channel in range(len(self.channels)):
+            self.ca[channel], self.hvd[channel] = dwt_ll(self.img_YUV[:, :, channel], self.dwt_level)
             # 转为4维度
-            self.ca_block[channel] = np.lib.stride_tricks.as_strided(self.ca[channel].astype(np.float32),
-                                                                     self.ca_block_shape, strides)
+            self.ca_block[channel] = tile_view(self.ca[channel], self.block_shape)
 
     def read_wm(self, wm_bit):
         self.wm_bit = wm_bit
@@ -79,12 +158,12 @@ class WaterMarkCore:
     def block_add_wm_slow(self, arg):
         block, shuffler, i = arg
         # dct->(flatten->加密->逆flatten)->svd->打水印->逆svd->(flatten->解密->逆flatten)->逆dct
-        wm_1 = self.wm_bit[i % self.wm_size]
+        wm_1 = self.wm_bit[self.plan.wm_index[i]]
         block_dct = dct(block)
 
         # 加密（打乱顺序）
         block_dct_shuffled = block_dct.flatten()[shuffler].reshape(self.block_shape)
-        u, s, v = svd(block_dct_shuffled)
+        u, s, v = svd(block_dct_shuffled, full_matrices=False)
         s[0] = (s[0] // self.d1 + 1 / 4 + 1 / 2 * wm_1) * self.d1
         if self.d2:
             s[1] = (s[1] // self.d2 + 1 / 4 + 1 / 2 * wm_1) * self.d2
@@ -96,46 +175,150 @@ class WaterMarkCore:
     def block_add_wm_fast(self, arg):
         # dct->svd->打水印->逆svd->逆dct
         block, shuffler, i = arg
-        wm_1 = self.wm_bit[i % self.wm_size]
+        wm_1 = self.wm_bit[self.plan.wm_index[i]]
 
-        u, s, v = svd(dct(block))
+        u, s, v = svd(dct(block), full_matrices=False)
         s[0] = (s[0] // self.d1 + 1 / 4 + 1 / 2 * wm_1) * self.d1
 
         return idct(np.dot(u, np.dot(np.diag(s), v)))
 
+    def host_svd(self):
+        # 原图每个 channel 的 tiles_svd 结果，cached 模式下读写 self.cache
+        if self.pool.mode == 'cached':
+            # 只用部分分块时，用到哪些分块由 wm_size 和 redundancy 决定
+            blocks = 'all' if self.plan.tile_index is None else '{}r{}'.format(self.wm_size, self.redundancy)
+            key = '{img_key}_{password_img}_{shuffle_version}_{block_shape}_L{dwt_level}_{blocks}_{channels}_{fast_mode}'.format(
+                img_key=self.img_key, password_img=self.password_img, shuffle_version=self.shuffle_version,
+                block_shape='x'.join(str(i) for i in self.block_shape), dwt_level=self.dwt_level, blocks=blocks,
+                channels=''.join(str(i) for i in self.channels), fast_mode=int(self.fast_mode))
+            factors = self.cache.get(key)
+            if factors is not None:
+                return [factors[i:i + 3] for i in range(0, len(factors), 3)]
+
+        factors = [item for factor in self.tiles_svd(self.img_YUV, self.idx_shuffle, self.plan.tile_index)
+                   for item in factor]
+
+        if self.pool.mode == 'cached':
+            factors = self.cache.put(key, factors)
+        return [factors[i:i + 3] for i in range(0, len(factors), 3)]
+
+    def tiles_svd(self, img_YUV, idx_shuffle, block_index=None):
+        # img_YUV 每个 channel 的像素分块做变换后 block_svd_batch 的结果，block_index 见 block_tiles
+        return tiles_svd(img_YUV, self.transform, idx_shuffle, self.fast_mode, block_index)
+
+    def add_wm_tiles(self, img_YUV, factors, idx_shuffle, wm_1, block_index=None):
+        # 打水印，原地加到 img_YUV 上，factors 是 tiles_svd 的结果
+        add_wm_tiles(img_YUV, self.transform, factors, idx_shuffle, wm_1, self.d1, self.d2, self.fast_mode,
+                     block_index)
+
+    @with_thread_limits
     def embed(self):
         self.init_block_index()
 
-        embed_ca = copy.deepcopy(self.ca)
-        embed_YUV = [np.array([])] * 3
+        if self.vec_mode:
+            factors = None if self.pool.banded else self.host_svd()
+            return embed_host(self.host, self.wm_bit[self.plan.wm_index], self.params, self.plan, self.pool, factors)
 
-        self.idx_shuffle = random_strategy1(self.password_img, self.block_num,
-                                            self.block_shape[0] * self.block_shape[1])
-        for channel in range(3):
+        embed_img_YUV = np.empty_like(self.img_YUV)
+
+        for channel in range(len(self.channels)):
+            # 每个 channel 一份 float32 的工作区，嵌入后的分块通过四维视图原地写回，右边和下边不能整除的长条保持不变
+            embed_ca = self.ca[channel].copy()
+            embed_ca_block = tile_view(embed_ca, self.block_shape)
             tmp = self.pool.map(self.block_add_wm,
-                                [(self.ca_block[channel][self.block_index[i]], self.idx_shuffle[i], i)
+                                [(self.ca_block[channel][tuple(self.block_index[i])], self.idx_shuffle[i], i)
                                  for i in range(self.block_num)])
 
             for i in range(self.block_num):
-                self.ca_block[channel][self.block_index[i]] = tmp[i]
-
-            # 4维分块变回2维
-            self.ca_part[channel] = np.concatenate(np.concatenate(self.ca_block[channel], 1), 1)
-            # 4维分块时右边和下边不能整除的长条保留，其余是主体部分，换成 embed 之后的频域的数据
-            embed_ca[channel][:self.part_shape[0], :self.part_shape[1]] = self.ca_part[channel]
-            # 逆变换回去
-            embed_YUV[channel] = idwt2((embed_ca[channel], self.hvd[channel]), "haar")
-
-        # 合并3通道
-        embed_img_YUV = np.stack(embed_YUV, axis=2)
-        # 之前如果不是2的整数，增加了白边，这里去除掉
-        embed_img_YUV = embed_img_YUV[:self.img_shape[0], :self.img_shape[1]]
-        embed_img = cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR)
-        embed_img = np.clip(embed_img, a_min=0, a_max=255)
-
-        if self.alpha is not None:
-            embed_img = cv2.merge([embed_img.astype(np.uint8), self.alpha])
-        return embed_img
+                embed_ca_block[tuple(self.block_index[i])] = tmp[i]
+
+            # 逆变换回去，逐层 idwt2
+            embed_img_YUV[:, :, channel] = idwt_ll(embed_ca, self.hvd[channel])
+
+        return self.merge_img(embed_img_YUV)
+
+    @with_thread_limits
+    def embed_img(self, img, wm_bit):
+        # 不改动 self 上的状态，把 wm_bit 嵌入 img，返回 uint8 的图，多个线程可以同时调用
+        # 结果与 vectorization 模式相同，multithreading/multiprocessing/executor 模式下按分块行分段派发
+        host = prepare_img(img, self.channels)
+        plan = self.params.get_plan(host.img.shape[:2], wm_bit.size, plan_dir=self.plan_dir)
+        return embed_host(host, wm_bit[plan.wm_index], self.params, plan, self.pool)
+
+    def embed_many(self, wm_bits):
+        # 同一张原图嵌入多个水印：原图只做一次分块 dct + svd，之后每个水印只重新量化奇异值、逆变换
+        # wm_bits 是可迭代对象，每次产出一张嵌入了对应水印的图，内存中同时只有一张输出图
+        # 用上全部分块时各水印共用一份 svd 结果；只用部分分块时，用到哪些分块由水印长度决定，每种长度各算一份
+        factors = {}
+        for wm_bit in wm_bits:
+            self.read_wm(wm_bit)
+            self.init_block_index()
+            key = None if self.plan.tile_index is None else self.wm_size
+            with self.pool.thread_limits():
+                if key not in factors:
+                    factors[key] = self.host_svd()
+                embed_img = embed_host(self.host, self.wm_bit[self.plan.wm_index], self.params, self.plan,
+                                       factors=factors[key])
+            yield embed_img
+
+    def merge_img(self, embed_img_YUV):
+        # YUV 变回 BGR，并恢复透明通道
+        return merge_img(embed_img_YUV, self.host, self.channels)
+
+    def strips(self, src, strip_height, wm_size):
+        # 把可按行切片的大图 src 按分块对齐切成条带，逐个产出
+        # (top, bottom, strip, img, strip_YUV, wm_index, idx_shuffle, block_index)，其中 wm_index 是条带内各分块嵌入的位，
+        # block_index 是条带内用到的分块的 (行, 列)，用上全部分块时为 None
+        img_shape = src.shape[:2]
+        padded_shape = [i + i % 2 for i in img_shape]
+        tile_shape = self.transform.tile_shape
+        grid_shape = get_grid_shape(img_shape, tile_shape)
+        check_capacity(grid_shape[0] * grid_shape[1], wm_size)
+
+        strip_rows = max(strip_height // tile_shape[0], 1)  # 每个条带包含的分块行数
+        shuffle = ShuffleStream(self.password_img, self.block_shape[0] * self.block_shape[1], self.shuffle_version)
+        # 只用部分分块时，计划只有 wm_size * redundancy 项，直接生成整张图的计划
+        plan = self.params.get_plan(img_shape, wm_size, plan_dir=self.plan_dir) \
+            if self.redundancy is not None and wm_size * self.redundancy < grid_shape[0] * grid_shape[1] else None
+        for row in range(0, grid_shape[0], strip_rows):
+            row_end = min(row + strip_rows, grid_shape[0])
+            top, bottom = row * tile_shape[0], min(row_end * tile_shape[0], img_shape[0])
+            strip = np.asarray(src[top:bottom])
+
+            img = strip[:, :, :3].astype(np.float32)
+            # 最后一个条带可能需要补上整图时的白边
+            strip_YUV = pad_img(bgr_to_yuv(img, self.channels),
+                                (row_end - row) * tile_shape[0] - (bottom - top), padded_shape[1] - img_shape[1])
+
+            if plan is None:
+                block_index = np.arange(row * grid_shape[1], row_end * grid_shape[1])
+                yield top, bottom, strip, img, strip_YUV, block_index % wm_size, shuffle.next(block_index.size), None
+            else:
+                blocks = row_slice(plan.block_index, row, row_end)
+                yield top, bottom, strip, img, strip_YUV, plan.wm_index[blocks], plan.idx_shuffle[blocks], \
+                    plan.block_index[blocks] - (row, 0)
+
+    @with_thread_limits
+    def embed_tiled(self, src, dst, strip_height=1024):
+        # 分条带嵌入，用于放不进内存的大图。src、dst 是形状相同、可按行切片的 (H, W, 3 或 4) uint8 数组，例如 np.memmap
+        # 每次只读入约 strip_height 行（与分块对齐），用全局的分块序号嵌入，结果与整图的 vectorization 模式一致
+        img_shape = src.shape[:2]
+        bottom = 0
+        for top, bottom, strip, img, strip_YUV, wm_index, idx_shuffle, block_index in \
+                self.strips(src, strip_height, self.wm_size):
+            embed_strip_YUV = strip_YUV.copy()
+            self.add_wm_tiles(embed_strip_YUV, self.tiles_svd(strip_YUV, idx_shuffle, block_index), idx_shuffle,
+                              self.wm_bit[wm_index], block_index)
+
+            dst[top:bottom, :, :3] = yuv_to_bgr(embed_strip_YUV[:bottom - top, :img_shape[1]],
+                                                strip_YUV[:bottom - top, :img_shape[1]], img, self.channels)
+            if strip.shape[2] == 4:
+                dst[top:bottom, :, 3] = strip[:, :, 3]
+
+        # 分块覆盖不到的最下面几行原样复制
+        if bottom < img_shape[0]:
+            dst[bottom:] = src[bottom:]
+        return dst
 
     def block_get_wm(self, args):
         if self.fast_mode:
@@ -148,7 +331,7 @@ class WaterMarkCore:
         # dct->flatten->加密->逆flatten->svd->解水印
         block_dct_shuffled = dct(block).flatten()[shuffler].reshape(self.block_shape)
 
-        u, s, v = svd(block_dct_shuffled)
+        s = svd(block_dct_shuffled, compute_uv=False)
         wm = (s[0] % self.d1 > self.d1 / 2) * 1
         if self.d2:
             tmp = (s[1] % self.d2 > self.d2 / 2) * 1
@@ -158,75 +341,538 @@ class WaterMarkCore:
     def block_get_wm_fast(self, args):
         block, shuffler = args
         # dct->svd->解水印
-        u, s, v = svd(dct(block))
+        s = svd(dct(block), compute_uv=False)
         wm = (s[0] % self.d1 > self.d1 / 2) * 1
 
         return wm
 
-    def extract_raw(self, img):
-        # 每个分块提取 1 bit 信息
-        self.read_img_arr(img=img)
-        self.init_block_index()
+    @with_thread_limits
+    def extract_bits(self, img, wm_size):
+        # 每个分块提取 1 bit 信息，返回 (wm_block_bit, plan)。不改动 self 上的状态，多个线程可以同时调用
+        host = prepare_img(img, self.channels)
+        plan = self.params.get_plan(host.img.shape[:2], wm_size, plan_dir=self.plan_dir)
 
-        wm_block_bit = np.zeros(shape=(3, self.block_num))  # 3个channel，length 个分块提取的水印，全都记录下来
+        if self.vec_mode:
+            return extract_host(host, self.params, plan, self.pool), plan
 
-        self.idx_shuffle = random_strategy1(seed=self.password_img,
-                                            size=self.block_num,
-                                            block_shape=self.block_shape[0] * self.block_shape[1],  # 16
-                                            )
-        for channel in range(3):
+        wm_block_bit = np.zeros(shape=(len(self.channels), plan.block_num))  # 每个channel，length 个分块提取的水印，全都记录下来
+        for channel in range(len(self.channels)):
+            ca_block = tile_view(dwt_ll(host.img_YUV[:, :, channel], self.dwt_level)[0], self.block_shape)
             wm_block_bit[channel, :] = self.pool.map(self.block_get_wm,
-                                                     [(self.ca_block[channel][self.block_index[i]], self.idx_shuffle[i])
-                                                      for i in range(self.block_num)])
-        return wm_block_bit
+                                                     [(ca_block[tuple(plan.block_index[i])], plan.idx_shuffle[i])
+                                                      for i in range(plan.block_num)])
+        return wm_block_bit, plan
 
-    def extract_avg(self, wm_block_bit):
-        # 对循环嵌入+3个 channel 求平均
-        wm_avg = np.zeros(shape=self.wm_size)
-        for i in range(self.wm_size):
-            wm_avg[i] = wm_block_bit[:, i::self.wm_size].mean()
-        return wm_avg
+    def extract_raw(self, img):
+        # 每个分块提取 1 bit 信息，同时更新 extract_avg 要用的 self.plan
+        wm_block_bit, self.plan = self.extract_bits(img, self.wm_size)
+        return wm_block_bit
 
-    def extract(self, img, wm_shape):
-        self.wm_size = np.array(wm_shape).prod()
+    @with_thread_limits
+    def extract_tiled(self, src, wm_shape, strip_height=1024, soft=False):
+        # 分条带提取，用于放不进内存的大图，src 是可按行切片的数组，例如 np.memmap
+        # 每个条带提取出各分块的 bit 后立即累加到对应的位上，不保存整张图的结果
+        # soft 为 True 时累加 bit_stats，返回每一位的 LLR，与 extract_llr 相同
+        wm_size = int(np.prod(wm_shape))
+        wm_sum, wm_count = np.zeros(wm_size), np.zeros(wm_size)
+        stats = 0
+        for top, bottom, strip, img, strip_YUV, wm_index, idx_shuffle, block_index in \
+                self.strips(src, strip_height, wm_size):
+            if soft:
+                stats += bit_stats(np.concatenate([get_wm_tiles(strip_YUV[:, :, channel], self.transform, idx_shuffle,
+                                                                self.d1, self.d2, self.fast_mode, block_index,
+                                                                soft=True).reshape(-1, len(idx_shuffle))
+                                                   for channel in range(len(self.channels))]), wm_index, wm_size)
+                continue
+            for channel in range(len(self.channels)):
+                wm_block_bit = get_wm_tiles(strip_YUV[:, :, channel], self.transform, idx_shuffle,
+                                            self.d1, self.d2, self.fast_mode, block_index)
+                wm_sum += np.bincount(wm_index, weights=wm_block_bit, minlength=wm_size)
+            wm_count += np.bincount(wm_index, minlength=wm_size) * len(self.channels)
+        if soft:
+            return bit_llr(stats)[0]
+        return wm_sum / wm_count
+
+    def extract_avg(self, wm_block_bit, weights=None):
+        # 对循环嵌入+各个 channel 求平均，见 average_bits
+        return average_bits(wm_block_bit, self.plan.wm_index, self.wm_size, weights=weights)
+
+    def extract(self, img, wm_shape, weights=None):
+        # 不改动 self 上的状态，同一个实例可以在多个线程中同时提取
+        if isinstance(img, np.memmap) and weights is None:
+            # 文件映射的大图不整个读入内存
+            return self.extract_tiled(img, wm_shape)
+
+        wm_size = int(np.prod(wm_shape))
 
         # 提取每个分块埋入的 bit：
-        wm_block_bit = self.extract_raw(img=img)
+        wm_block_bit, plan = self.extract_bits(img, wm_size)
         # 做平均：
-        wm_avg = self.extract_avg(wm_block_bit)
-        return wm_avg
-
-    def extract_with_kmeans(self, img, wm_shape):
-        wm_avg = self.extract(img=img, wm_shape=wm_shape)
+        return average_bits(wm_block_bit, plan.wm_index, wm_size, weights=weights)
+
+    @with_thread_limits
+    def extract_llr(self, img, wm_shape):
+        # 不改动 self 上的状态，返回每一位的 LLR（正数表示 1），见 extract_llr
+        if isinstance(img, np.memmap):
+            return self.extract_tiled(img, wm_shape, soft=True)
+        return extract_llr(img, int(np.prod(wm_shape)), self.params, pool=self.pool if self.pool.banded else None,
+                           plan_dir=self.plan_dir)
+
+    @with_thread_limits
+    def extract_progressive(self, img, wm_shape, confidence=0.999, max_ms=None):
+        # 不改动 self 上的状态，一轮一轮地提取，所有位都足够可信或超时就提前结束，见 extract_progressive
+        return extract_progressive(img, int(np.prod(wm_shape)), self.params, confidence=confidence, max_ms=max_ms,
+                                   plan_dir=self.plan_dir)
+
+    def extract_many(self, imgs, wm_shape, batch_size=64, soft=False):
+        # imgs 是可迭代的多张图，形状相同的图攒够 batch_size 张就用 extract_batch 一起提取，最后把不满一批的也提取完
+        # 按完成的先后产出 (序号, wm_avg)，内存中最多有 形状种数 * batch_size 张图。结果与 vectorization 模式相同
+        # soft 为 True 时产出 (序号, llr)，与 extract_llr 相同
+        wm_size = int(np.prod(wm_shape))
+        groups = {}
+
+        def flush(shape):
+            indexes, batch = zip(*groups.pop(shape))
+            with self.pool.thread_limits():
+                return zip(indexes, extract_batch(batch, wm_size, self.params, plan_dir=self.plan_dir, soft=soft))
+
+        for i, img in enumerate(imgs):
+            groups.setdefault(img.shape, []).append((i, img))
+            if len(groups[img.shape]) >= batch_size:
+                yield from flush(img.shape)
+        for shape in list(groups):
+            yield from flush(shape)
+
+    def extract_with_kmeans(self, img, wm_shape, weights=None):
+        wm_avg = self.extract(img=img, wm_shape=wm_shape, weights=weights)
 
         return one_dim_kmeans(wm_avg)
 
 
-def one_dim_kmeans(inputs):
-    threshold = 0
-    e_tol = 10 ** (-6)
-    center = [inputs.min(), inputs.max()]  # 1. 初始化中心点
-    for i in range(300):
-        threshold = (center[0] + center[1]) / 2
-        is_class01 = inputs > threshold  # 2. 检查所有点与这k个点之间的距离，每个点归类到最近的中心
-        center = [inputs[~is_class01].mean(), inputs[is_class01].mean()]  # 3. 重新找中心点
-        if np.abs((center[0] + center[1]) / 2 - threshold) < e_tol:  # 4. 停止条件
-            threshold = (center[0] + center[1]) / 2
+def check_block_shape(block_shape):
+    # 分块的高、宽都要是偶数（cv2.dct 的要求），且至少为 2（嵌入时要改动前两个奇异值）
+    block_shape = tuple(int(i) for i in block_shape)
+    assert len(block_shape) == 2 and all(i >= 2 and i % 2 == 0 for i in block_shape), \
+        'block_shape should be 2 even numbers, like (4, 4), (8, 8) or (4, 8)'
+    return block_shape
+
+
+def check_dwt_level(dwt_level):
+    assert dwt_level in (1, 2, 3), 'dwt_level should be 1, 2 or 3'
+    return int(dwt_level)
+
+
+def get_grid_shape(img_shape, tile_shape):
+    # 分块的行数、列数。原图补白边成偶数后，只取完整的 tile_shape = block_shape * 2 ** dwt_level 像素分块
+    return tuple(int((i + i % 2) // j) for i, j in zip(img_shape, tile_shape))
+
+
+def dwt_ll(plane, dwt_level):
+    # 连续做 dwt_level 层 haar 小波，每层只对上一层的 LL 做。返回 (最后一层的 LL, 每层的 (hvd, 该层输入的形状))
+    hvds = []
+    for _ in range(dwt_level):
+        ca, hvd = dwt2(plane, 'haar')
+        hvds.append((hvd, plane.shape))
+        plane = ca
+    return plane, hvds
+
+
+def idwt_ll(ca, hvds):
+    # dwt_ll 的逆变换，从最后一层开始逐层 idwt2。某层输入的边长是奇数时，idwt2 的结果多出一行/列，截掉
+    for hvd, shape in reversed(hvds):
+        ca = idwt2((ca, hvd), 'haar')[:shape[0], :shape[1]]
+    return ca
+
+
+def check_redundancy(redundancy):
+    assert redundancy is None or int(redundancy) >= 1, 'redundancy should be None or a positive integer'
+    return None if redundancy is None else int(redundancy)
+
+
+def check_capacity(block_num, wm_size):
+    assert wm_size < block_num, IndexError(
+        '最多可嵌入{}kb信息，多于水印的{}kb信息，溢出'.format(block_num / 1000, wm_size / 1000))
+
+
+def prepare_img(img, channels):
+    # 处理透明图，转为 float32、YUV 化、加白边使像素变偶数，返回 HostImage
+    # 透明通道只在不全是 255 时保留，输出时放回；全不透明的四通道图（例如截图的 PNG）输出三通道图
+    alpha = None
+    if img.shape[2] == 4:
+        if img[:, :, 3].min() < 255:
+            alpha = img[:, :, 3]
+        img = img[:, :, :3]
+
+    img = img.astype(np.float32)
+    # 如果不是偶数，那么补上白边，Y（明亮度）UV（颜色）
+    img_YUV = pad_img(bgr_to_yuv(img, channels), img.shape[0] % 2, img.shape[1] % 2)
+    return HostImage(img, img_YUV, alpha)
+
+
+def merge_img(embed_img_YUV, host, channels):
+    # YUV 变回 BGR，并恢复透明通道
+    # 之前如果不是2的整数，增加了白边，这里去除掉
+    height, width = host.img.shape[:2]
+    embed_img = yuv_to_bgr(embed_img_YUV[:height, :width], host.img_YUV[:height, :width], host.img, channels)
+
+    if host.alpha is not None:
+        embed_img = cv2.merge([embed_img, host.alpha])
+    return embed_img
+
+
+def bands(plan, pool):
+    # 按分块行把全部分块切成若干段，产出每段的 (起始行, 结束行, 分块序号的切片, 段内分块的 (行, 列) 或 None)
+    grid_rows = plan.grid_shape[0]
+    band_rows = pool.band_rows(plan.grid_shape)
+    for row in range(0, grid_rows, band_rows):
+        row_end = min(row + band_rows, grid_rows)
+        blocks = row_slice(plan.block_index, row, row_end)
+        yield row, row_end, blocks, None if plan.tile_index is None else plan.tile_index[blocks] - (row, 0)
+
+
+def band_args(params):
+    # 任务重建 BlockTransform 和打水印所需的参数，都是很小的可 pickle 对象
+    return params.block_shape, params.transform.dwt_level, params.d1, params.d2, params.fast_mode
+
+
+def embed_host(host, wm_1, params, plan, pool=None, factors=None):
+    '''
+    把 wm_1 嵌入 host，返回 uint8 的图，不改动任何输入。
+    wm_1 是每个分块要嵌入的 bit，即 wm_bit[plan.wm_index]；factors 是 tiles_svd 的结果，None 时现算
+    pool.banded 为 True 时，host.img_YUV 复制到共享内存，每个任务只带上一段分块的打乱顺序和水印 bit，原地写回
+    '''
+    if pool is not None and pool.banded:
+        shared = SharedArray.copy_from(host.img_YUV)
+        try:
+            pool.map(embed_band, [(shared, row, row_end, plan.idx_shuffle[blocks], wm_1[blocks], block_index,
+                                   band_args(params))
+                                  for row, row_end, blocks, block_index in bands(plan, pool)])
+            return merge_img(shared.ndarray(), host, params.channels)
+        finally:
+            shared.unlink()
+
+    transform = params.transform
+    if factors is None:
+        factors = tiles_svd(host.img_YUV, transform, plan.idx_shuffle, params.fast_mode, plan.tile_index)
+    embed_img_YUV = host.img_YUV.copy()
+    add_wm_tiles(embed_img_YUV, transform, factors, plan.idx_shuffle, wm_1, params.d1, params.d2, params.fast_mode,
+                 plan.tile_index)
+    return merge_img(embed_img_YUV, host, params.channels)
+
+
+def extract_host(host, params, plan, pool=None, soft=False):
+    # 每个分块提取 1 bit，返回 (channel数, block_num)。pool.banded 为 True 时与 embed_host 相同的分段方式
+    # soft 为 True 时返回各分块的软值，形状 (channel数 * 奇异值个数, block_num)，见 block_soft_batch
+    if pool is not None and pool.banded:
+        shared = SharedArray.copy_from(host.img_YUV)
+        try:
+            wm_block_bit = pool.map(extract_band, [(shared, row, row_end, plan.idx_shuffle[blocks], block_index,
+                                                    band_args(params), soft)
+                                                   for row, row_end, blocks, block_index in bands(plan, pool)])
+        finally:
+            shared.unlink()
+        return np.concatenate(wm_block_bit, axis=1)
+
+    transform = params.transform
+    return np.concatenate([get_wm_tiles(host.img_YUV[:, :, channel], transform, plan.idx_shuffle,
+                                        params.d1, params.d2, params.fast_mode, plan.tile_index, soft=soft)
+                           .reshape(-1, plan.block_num)
+                           for channel in range(host.img_YUV.shape[2])])
+
+
+def average_bits(wm_block_bit, wm_index, wm_size, weights=None):
+    # 对循环嵌入+各个 channel 求平均，按 wm_index 把每个分块归到对应的那一位，一次 bincount 完成
+    # weights 可以广播到 wm_block_bit 的形状，例如 (channel数, 1) 是各 channel 的权重，(block_num,) 是各分块的权重
+    if weights is None:
+        wm_sum = np.bincount(wm_index, weights=wm_block_bit.sum(axis=0), minlength=wm_size)
+        return wm_sum / (np.bincount(wm_index, minlength=wm_size) * wm_block_bit.shape[0])
+
+    weights = np.broadcast_to(weights, wm_block_bit.shape)
+    wm_sum = np.bincount(wm_index, weights=(wm_block_bit * weights).sum(axis=0), minlength=wm_size)
+    return wm_sum / np.bincount(wm_index, weights=weights.sum(axis=0), minlength=wm_size)
+
+
+def embed_array(img, wm_bit, params=WatermarkParams(), executor=None, chunk_size=None, plan_dir=None):
+    '''
+    无状态的嵌入：把 wm_bit 嵌入 img，返回 uint8 的图，结果与 mode='vectorization' 相同。
+    不保存任何中间状态，可以在多个线程中同时调用。
+    :param img: (H, W, 3) 或 (H, W, 4) 的 BGR 图
+    :param wm_bit: 一维 bool/0-1 数组，即 WaterMarkCore.read_wm 接收的（已加密的）水印
+    :param params: WatermarkParams
+    :param executor, chunk_size: 同 WaterMark，None 表示在当前线程中计算
+    '''
+    wm_bit = np.asarray(wm_bit)
+    host = prepare_img(img, params.channels)
+    plan = params.get_plan(host.img.shape[:2], wm_bit.size, plan_dir=plan_dir)
+    pool = AutoPool('vectorization', None, executor=executor, chunk_size=chunk_size)
+    return embed_host(host, wm_bit[plan.wm_index], params, plan, pool)
+
+
+def extract_array(img, wm_size, params=WatermarkParams(), weights=None, executor=None, chunk_size=None,
+                  plan_dir=None):
+    '''
+    无状态的提取，返回长度为 wm_size 的数组，每一位是该位各次嵌入提取结果的平均值，结果与 mode='vectorization' 相同。
+    参数同 embed_array，weights 同 WaterMarkCore.extract
+    '''
+    host = prepare_img(img, params.channels)
+    plan = params.get_plan(host.img.shape[:2], wm_size, plan_dir=plan_dir)
+    pool = AutoPool('vectorization', None, executor=executor, chunk_size=chunk_size)
+    return average_bits(extract_host(host, params, plan, pool), plan.wm_index, int(wm_size), weights=weights)
+
+
+def extract_llr(img, wm_size, params=WatermarkParams(), pool=None, plan_dir=None):
+    '''
+    无状态的软判决提取，返回长度为 wm_size 的数组，每一位的对数似然比（LLR），正数表示 1，绝对值越大越可信。
+    每个分块、每个 channel 的 s0、s1 都给出软值（见 block_soft_batch），由 bit_llr 按各自实测的可靠性加权合成
+    '''
+    host = prepare_img(img, params.channels)
+    plan = params.get_plan(host.img.shape[:2], wm_size, plan_dir=plan_dir)
+    return bit_llr(bit_stats(extract_host(host, params, plan, pool, soft=True), plan.wm_index, int(wm_size)))[0]
+
+
+def extract_progressive(img, wm_size, params=WatermarkParams(), confidence=0.999, max_ms=None, plan_dir=None,
+                        step_blocks=4096):
+    '''
+    渐进式提取：按 visit_rounds 的顺序每次提取约 step_blocks 个分块，累加每一位的投票。
+    每一位的投票都在 [0, 1] 之间，由 Hoeffding 不等式，均值 m 来自 n 票时判错的概率不超过 exp(-2 n (m - 1/2)^2)，
+    所有位的置信度 1 - exp(-2 n (m - 1/2)^2) 都不小于 confidence、或者用时超过 max_ms 毫秒时提前结束。
+    干净的图通常只需访问一小部分分块。全部分块访问完时，结果与 extract_array 相同（浮点误差以内）
+    返回 (wm_avg, wm_confidence)，两者长度都是 wm_size，还没有投票的位 wm_avg 为 0.5，置信度为 0
+    '''
+    start_time = time.perf_counter()
+    host = prepare_img(img, params.channels)
+    plan = params.get_plan(host.img.shape[:2], wm_size, plan_dir=plan_dir)
+    transform = params.transform
+    planes = [host.img_YUV[:, :, channel] for channel in range(host.img_YUV.shape[2])]
+
+    wm_sum, wm_count = np.zeros(wm_size), np.zeros(wm_size)
+    wm_avg, wm_confidence = np.full(wm_size, 0.5), np.zeros(wm_size)
+    for blocks in visit_rounds(plan, step_blocks):
+        block_index, idx_shuffle, wm_index = plan.block_index[blocks], plan.idx_shuffle[blocks], plan.wm_index[blocks]
+        for plane in planes:
+            wm_block_bit = get_wm_tiles(plane, transform, idx_shuffle, params.d1, params.d2, params.fast_mode,
+                                        block_index)
+            wm_sum += np.bincount(wm_index, weights=wm_block_bit, minlength=wm_size)
+        wm_count += np.bincount(wm_index, minlength=wm_size) * len(planes)
+
+        voted = wm_count > 0
+        wm_avg[voted] = wm_sum[voted] / wm_count[voted]
+        wm_confidence = 1 - np.exp(-2 * wm_count * (wm_avg - 0.5) ** 2)
+        if wm_confidence.min() >= confidence:
+            break
+        if max_ms is not None and (time.perf_counter() - start_time) * 1000 >= max_ms:
             break
+    return wm_avg, wm_confidence
+
+
+def extract_batch(imgs, wm_size, params=WatermarkParams(), plan_dir=None, soft=False):
+    '''
+    多张形状相同的图一起提取：YUV 图叠成一个 (图片数, H, W, channel数) 的数组，共用同一个 plan 和打乱顺序，
+    每个 channel 的分块变换和奇异值判决对整批图一次完成。
+    返回 (图片数, wm_size)，每一行与 extract_array 的结果相同；soft 为 True 时每一行与 extract_llr 的结果相同
+    '''
+    hosts = [prepare_img(img, params.channels) for img in imgs]
+    plan = params.get_plan(hosts[0].img.shape[:2], wm_size, plan_dir=plan_dir)
+    img_YUV = np.stack([host.img_YUV for host in hosts])
+    transform = params.transform
+
+    if soft:
+        soft_bits = np.concatenate([get_wm_tiles(img_YUV[..., channel], transform, plan.idx_shuffle, params.d1,
+                                                 params.d2, params.fast_mode, plan.tile_index, soft=True)
+                                    for channel in range(img_YUV.shape[3])], axis=1)
+        return np.array([bit_llr(bit_stats(bits, plan.wm_index, int(wm_size)))[0] for bits in soft_bits])
 
-    is_class01 = inputs > threshold
-    return is_class01
+    wm_block_bit = np.empty((len(hosts), img_YUV.shape[3], plan.block_num))
+    for channel in range(img_YUV.shape[3]):
+        wm_block_bit[:, channel] = get_wm_tiles(img_YUV[..., channel], transform, plan.idx_shuffle,
+                                                params.d1, params.d2, params.fast_mode, plan.tile_index)
+    return np.array([average_bits(bits, plan.wm_index, int(wm_size)) for bits in wm_block_bit])
 
 
-def random_strategy1(seed, size, block_shape):
-    return np.random.RandomState(seed) \
-        .random(size=(size, block_shape)) \
-        .argsort(axis=1)
+def one_dim_kmeans(inputs):
+    # 一维数据分成两类，返回是否属于较大的一类。
+    # 用 otsu_threshold 闭式求出 k=2 的 k-means 的全局最优分割，不再迭代
+    return inputs > otsu_threshold(inputs)
+
+
+def pad_img(img, pad_bottom, pad_right):
+    # 下边、右边补 0，保持 (H, W, channel) 三维
+    padded = cv2.copyMakeBorder(img, 0, pad_bottom, 0, pad_right, cv2.BORDER_CONSTANT, value=(0, 0, 0))
+    return padded.reshape(img.shape[0] + pad_bottom, img.shape[1] + pad_right, -1)
+
 
+def bgr_to_yuv(img, channels):
+    # img 是 float32 的 BGR 图，返回只含 channels 这几个通道的 YUV 图
+    if len(channels) == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2YUV)
+    # 只计算用到的通道
+    return cv2.transform(img, yuv_matrix(channels)).reshape(*img.shape[:2], -1)
 
-def random_strategy2(seed, size, block_shape):
-    one_line = np.random.RandomState(seed) \
-        .random(size=(1, block_shape)) \
-        .argsort(axis=1)
 
-    return np.repeat(one_line, repeats=size, axis=0)
+def yuv_to_bgr(embed_img_YUV, img_YUV, img, channels):
+    # 嵌入后的 YUV 图变回 BGR，截断到 [0, 255]、四舍五入并转为 uint8
+    # img_YUV、img 是嵌入前的 YUV 图和 BGR 图
+    if len(channels) == 3:
+        return to_uint8(cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR))
+    # 颜色空间变换是线性的，只需把用到的通道的改动量变换回 BGR，加到原图上
+    delta_YUV = np.subtract(embed_img_YUV, img_YUV, dtype=np.float32)
+    delta_img = cv2.transform(delta_YUV, bgr_matrix(channels)).reshape(img.shape)
+    return cv2.add(img, delta_img, dtype=cv2.CV_8U)
+
+
+def to_uint8(img):
+    # 截断、四舍五入、转 uint8 一步完成，不产生中间数组
+    return cv2.addWeighted(img, 1, img, 0, 0, dtype=cv2.CV_8U)
+
+
+def yuv_matrix(channels):
+    # cv2.COLOR_BGR2YUV 中 channels 对应的几行，形状 (len(channels), 4)，可直接用于 cv2.transform
+    bgr = np.array([[[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]]], dtype=np.float32)
+    yuv = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV)[0]
+    mat = np.hstack([(yuv[1:] - yuv[0]).T, yuv[0][:, np.newaxis]])
+    return mat[list(channels)]
+
+
+def bgr_matrix(channels):
+    # cv2.COLOR_YUV2BGR 线性部分中 channels 对应的几列，形状 (3, len(channels))，用于把 YUV 的改动量变回 BGR
+    yuv = np.array([[[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]]], dtype=np.float32)
+    bgr = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR)[0]
+    return (bgr[1:] - bgr[0]).T[:, list(channels)]
+
+
+def top_singular_values(blocks, k=2):
+    # 批量求每个分块最大的 k 个奇异值（降序）。
+    # 奇异值是 Gram 矩阵 X @ X.T 特征值的平方根，对小矩阵 eigvalsh 比 svd(compute_uv=False) 快一倍左右
+    blocks = blocks.astype(np.float64)
+    if blocks.shape[-2] > blocks.shape[-1]:
+        blocks = blocks.swapaxes(-1, -2)
+    eig = np.linalg.eigvalsh(blocks @ blocks.swapaxes(-1, -2))
+    return np.sqrt(np.maximum(eig[..., :-k - 1:-1], 0))
+
+
+def block_svd_batch(block_dct, shuffler, fast_mode=False):
+    # 一次处理一个 channel 的全部分块，block_dct.shape = (block_num, block_shape[0], block_shape[1])
+    # 加密（打乱顺序）后做 svd，只保留嵌入时会改动的前 rank 个奇异值和对应的奇异向量
+    block_num = block_dct.shape[0]
+
+    if not fast_mode:
+        # 加密（打乱顺序），一次 gather 完成
+        block_dct = np.take_along_axis(block_dct.reshape(block_num, -1), shuffler, axis=1) \
+            .reshape(block_dct.shape)
+
+    u, s, v = np.linalg.svd(block_dct, full_matrices=False)
+    rank = 1 if fast_mode else 2
+    return u[:, :, :rank], s[:, :rank], v[:, :rank, :]
+
+
+def block_add_wm_batch(u, s, v, shuffler, wm_1, d1, d2, fast_mode=False):
+    # 只有 s[0], s[1] 被改动，因此只需算出低秩修正量 Δs0·u0·v0ᵀ + Δs1·u1·v1ᵀ，
+    # 解密是线性变换，对修正量做完即可。返回 dct 系数的修正量，不必完整重建 u @ diag(s) @ v
+    block_num = u.shape[0]
+    rank = 1 if fast_mode or not d2 else 2
+    delta_s = np.empty((block_num, rank), dtype=s.dtype)
+    delta_s[:, 0] = (s[:, 0] // d1 + 1 / 4 + 1 / 2 * wm_1) * d1 - s[:, 0]
+    if rank == 2:
+        delta_s[:, 1] = (s[:, 1] // d2 + 1 / 4 + 1 / 2 * wm_1) * d2 - s[:, 1]
+
+    delta_dct = (u[:, :, :rank] * delta_s[:, np.newaxis, :]) @ v[:, :rank, :]
+
+    if not fast_mode:
+        # 解密，一次 scatter 完成
+        delta_dct_flatten = np.empty_like(delta_dct).reshape(block_num, -1)
+        np.put_along_axis(delta_dct_flatten, shuffler, delta_dct.reshape(block_num, -1), axis=1)
+        delta_dct = delta_dct_flatten.reshape(delta_dct.shape)
+
+    return delta_dct
+
+
+def block_top_s(block_dct, shuffler, fast_mode=False):
+    # 每个分块加密（打乱顺序）后的 s[0] 和 s[1]，block_dct.shape = (..., block_num, block_shape[0], block_shape[1])，
+    # 前导维度（例如多张同样大小的图）共用同一个 shuffler
+    if not fast_mode:
+        block_dct_flatten = block_dct.reshape(block_dct.shape[:-2] + (-1,))
+        block_dct = np.take_along_axis(block_dct_flatten, np.broadcast_to(shuffler, block_dct_flatten.shape), axis=-1) \
+            .reshape(block_dct.shape)
+
+    # 提取只用到 s[0] 和 s[1]，不需要计算 u, v
+    return top_singular_values(block_dct, k=2)
+
+
+def block_get_wm_batch(block_dct, shuffler, d1, d2, fast_mode=False):
+    # 一次提取一个 channel 全部分块的 bit，参数见 block_top_s
+    s = block_top_s(block_dct, shuffler, fast_mode)
+    wm = (s[..., 0] % d1 > d1 / 2) * 1
+    if d2 and not fast_mode:
+        tmp = (s[..., 1] % d2 > d2 / 2) * 1
+        wm = (wm * 3 + tmp * 1) / 4
+    return wm
+
+
+def block_tiles(plane, transform, block_index=None):
+    # plane 的像素分块，形状 (..., 分块数, tile_shape[0], tile_shape[1])
+    # block_index 为 None 时按行优先取全部分块，否则只取 block_index 中各个 (行, 列) 的分块（复制出来）
+    tiles = tile_view(plane, transform.tile_shape)
+    if block_index is None:
+        return tiles.reshape(tiles.shape[:-4] + (-1,) + transform.tile_shape)
+    return tiles[..., block_index[:, 0], block_index[:, 1], :, :]
+
+
+def block_soft_batch(block_dct, shuffler, d1, d2, fast_mode=False):
+    # 与 block_get_wm_batch 相同，但返回 s[0]、s[1] 各自的 soft_margin，不做硬判决
+    # 形状 (..., 奇异值个数, block_num)，fast_mode 或 d2 为 0 时只有 s[0] 一行
+    s = block_top_s(block_dct, shuffler, fast_mode)
+    soft = [soft_margin(s[..., 0], d1)]
+    if d2 and not fast_mode:
+        soft.append(soft_margin(s[..., 1], d2))
+    return np.stack(soft, axis=-2)
+
+
+def tiles_svd(img_YUV, transform, idx_shuffle, fast_mode=False, block_index=None):
+    # img_YUV 每个 channel 的像素分块经 transform 变为 dct 系数后 block_svd_batch 的结果
+    factors = []
+    for channel in range(img_YUV.shape[2]):
+        block_dct = transform.forward(block_tiles(img_YUV[:, :, channel], transform, block_index))
+        factors.append(block_svd_batch(block_dct, idx_shuffle, fast_mode))
+    return factors
+
+
+def add_wm_tiles(img_YUV, transform, factors, idx_shuffle, wm_1, d1, d2, fast_mode=False, block_index=None):
+    # 像素分块 -> dct 系数 -> 打水印得到系数修正量 -> 变回像素修正量，原地加到 img_YUV 上
+    # factors 是 tiles_svd 的结果，block_index 见 block_tiles，不在其中的分块不改动
+    for channel, (u, s, v) in enumerate(factors):
+        tiles = tile_view(img_YUV[:, :, channel], transform.tile_shape)
+        delta = transform.inverse(block_add_wm_batch(u, s, v, idx_shuffle, wm_1, d1, d2, fast_mode))
+        if block_index is None:
+            tiles += delta.reshape(tiles.shape)
+        else:
+            tiles[block_index[:, 0], block_index[:, 1]] += delta
+
+
+def get_wm_tiles(plane, transform, idx_shuffle, d1, d2, fast_mode=False, block_index=None, soft=False):
+    # 二维 plane 的像素分块经 transform 变为 dct 系数后，每个分块提取 1 bit，block_index 见 block_tiles
+    # plane 也可以是 (图片数, H, W)，这时返回 (图片数, block_num)。soft 为 True 时返回 block_soft_batch 的软值
+    block_dct = transform.forward(block_tiles(plane, transform, block_index))
+    if soft:
+        return block_soft_batch(block_dct, idx_shuffle, d1, d2, fast_mode)
+    return block_get_wm_batch(block_dct, idx_shuffle, d1, d2, fast_mode)
+
+
+def embed_band(task):
+    # multithreading/multiprocessing/executor 模式的任务：对共享内存里 img_YUV 的第 [row, row_end) 行分块打水印，原地写回
+    # block_index 是段内用到的分块的 (行, 列)，None 表示全部分块
+    shared, row, row_end, idx_shuffle, wm_1, block_index, (block_shape, dwt_level, d1, d2, fast_mode) = task
+    transform = get_block_transform(block_shape, dwt_level)
+    band = shared.ndarray()[row * transform.tile_shape[0]:row_end * transform.tile_shape[0]]
+    add_wm_tiles(band, transform, tiles_svd(band, transform, idx_shuffle, fast_mode, block_index), idx_shuffle, wm_1,
+                 d1, d2, fast_mode, block_index)
+
+
+def extract_band(task):
+    # multithreading/multiprocessing/executor 模式的任务：提取共享内存里 img_YUV 的第 [row, row_end) 行分块的 bit，形状 (channel数, 分块数)
+    # soft 为 True 时提取软值，形状 (channel数 * 奇异值个数, 分块数)
+    shared, row, row_end, idx_shuffle, block_index, (block_shape, dwt_level, d1, d2, fast_mode), soft = task
+    transform = get_block_transform(block_shape, dwt_level)
+    band = shared.ndarray()[row * transform.tile_shape[0]:row_end * transform.tile_shape[0]]
+    return np.concatenate([get_wm_tiles(band[:, :, channel], transform, idx_shuffle, d1, d2, fast_mode, block_index,
+                                        soft=soft).reshape(-1, len(idx_shuffle))
+                           for channel in range(band.shape[2])])
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 缓存原图分解结果（每个分块 dct 后的 svd），同一张图嵌入不同水印时只需重新量化奇异值
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+import numpy as np
+
+
+def content_hash(img):
+    # 图片内容的哈希，形状和类型也计入，避免不同形状的图恰好字节相同
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((img.shape, img.dtype.str)).encode())
+    h.update(np.ascontiguousarray(img).data)
+    return h.hexdigest()
+
+
+def value_nbytes(value):
+    # value 中 numpy.array 的总字节数，value 是 numpy.array，或者由 numpy.array 和其它对象组成的 list/tuple
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return sum(item.nbytes for item in value if isinstance(item, np.ndarray))
+
+
+class HostCache:
+    '''
+    原图分解结果的 LRU 缓存。
+
+    key 是字符串，value 是若干 numpy.array 组成的 list。
+    不用 spill_dir 时 key 可以是任意可哈希对象，value 也可以是 value_nbytes 支持的其它对象，见 cached_by
+    :param max_bytes: 内存中缓存的总字节数上限，超出时淘汰最久未使用的条目
+    :param spill_dir: 若不为 None，put 时同时把每个条目写入该目录下的一个子目录（每个数组一个 .npy 文件），
+        之后以只读 memmap 方式读回。多个进程用同一个目录即可共享缓存，内存中被淘汰的条目也能从磁盘找回。
+        子目录先写在临时目录中，写完后才改名，其它进程只会看到完整的条目
+    '''
+
+    def __init__(self, max_bytes=512 * 2 ** 20, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, key)
+
+    def load(self, path):
+        # 以只读 memmap 方式读回 path 目录下的 0.npy, 1.npy, ...
+        num = len([name for name in os.listdir(path) if name.endswith('.npy')])
+        return [np.load(os.path.join(path, '{i}.npy'.format(i=i)), mmap_mode='r') for i in range(num)]
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.spill_dir is None or not os.path.isdir(self.spill_path(key)):
+            return None
+
+        value = self.load(self.spill_path(key))
+        self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        if self.spill_dir is not None:
+            path = self.spill_path(key)
+            # 先写到临时目录，全部写完再改名，防止其它进程读到只写了一部分数组的条目
+            tmp_path = path + '.{pid}.{thread}.tmp'.format(pid=os.getpid(), thread=threading.get_ident())
+            os.makedirs(tmp_path, exist_ok=True)
+            for i, arr in enumerate(value):
+                np.save(os.path.join(tmp_path, '{i}.npy'.format(i=i)), arr)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # 其它进程已经写好了同一个条目，内容相同，用已有的
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                if not os.path.isdir(path):
+                    raise
+            value = self.load(path)
+
+        self.remember(key, value)
+        return value
+
+    def remember(self, key, value):
+        size = value_nbytes(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= value_nbytes(self.entries.pop(key))
+            self.entries[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= value_nbytes(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+def cached_by(cache):
+    '''
+    与 functools.lru_cache 类似，把函数的结果按参数存入 cache（不用 spill_dir 的 HostCache），
+    但按结果中 numpy.array 的总字节数而不是条目数限制缓存大小。参数都要是可哈希的，结果不能是 None
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+            value = cache.get(key)
+            if value is None:
+                value = func(*args, **kwargs)
+                cache.remember(key, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+default_host_cache = HostCache()
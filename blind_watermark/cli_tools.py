@@ -1,17 +1,26 @@
+import os
+from collections import Counter
 from optparse import OptionParser
 from .blind_watermark import WaterMark
 
 usage1 = 'blind_watermark --embed --pwd 1234 image.jpg "watermark text" embed.png'
 usage2 = 'blind_watermark --extract --pwd 1234 --wm_shape 111 embed.png'
-optParser = OptionParser(usage=usage1 + '\n' + usage2)
+usage3 = 'blind_watermark --embed_batch --pwd 1234 --out_dir output "watermark text" image1.jpg image2.jpg ...'
+optParser = OptionParser(usage=usage1 + '\n' + usage2 + '\n' + usage3)
 
 optParser.add_option('--embed', dest='work_mode', action='store_const', const='embed'
                      , help='Embed watermark into images')
 optParser.add_option('--extract', dest='work_mode', action='store_const', const='extract'
                      , help='Extract watermark from images')
+optParser.add_option('--embed_batch', dest='work_mode', action='store_const', const='embed_batch'
+                     , help='Embed watermark into many images, decoding, embedding and encoding in parallel')
 
 optParser.add_option('-p', '--pwd', dest='password', help='password, like 1234')
 optParser.add_option('--wm_shape', dest='wm_shape', help='Watermark shape, like 120')
+optParser.add_option('--out_dir', dest='out_dir', help='Output directory of --embed_batch')
+optParser.add_option('--decoders', dest='decoders', type='int', default=2, help='Threads reading images, default 2')
+optParser.add_option('--workers', dest='workers', type='int', default=1, help='Threads embedding, default 1')
+optParser.add_option('--encoders', dest='encoders', type='int', default=2, help='Threads writing images, default 2')
 
 (opts, args) = optParser.parse_args()
 
@@ -30,6 +39,33 @@ def main():
             print('Embed succeed! to file ', args[2])
             print('Put down watermark size:', len(bwm1.wm_bit))
 
+    if opts.work_mode == 'embed_batch':
+        if len(args) < 2 or opts.out_dir is None:
+            print('Error! Usage: ')
+            print(usage3)
+            return
+        elif min(opts.decoders, opts.workers, opts.encoders) < 1:
+            print('Error! --decoders, --workers and --encoders should be at least 1')
+            return
+        else:
+            jobs = [(filename, os.path.join(opts.out_dir, os.path.basename(filename))) for filename in args[1:]]
+            # 输出文件名取自输入的文件名，文件名相同的输入会互相覆盖
+            duplicates = sorted(dst for dst, num in Counter(os.path.normcase(os.path.abspath(dst))
+                                                            for _, dst in jobs).items() if num > 1)
+            if duplicates:
+                print('Error! Images with the same file name would overwrite each other in --out_dir:')
+                for dst in duplicates:
+                    print(dst)
+                return
+            bwm1.read_wm(args[0], mode='str')
+            os.makedirs(opts.out_dir, exist_ok=True)
+            failures = bwm1.embed_batch(jobs, decoders=opts.decoders, workers=opts.workers, encoders=opts.encoders)
+            print('Embed succeed! {} of {} images to directory '.format(len(jobs) - len(failures), len(jobs)),
+                  opts.out_dir)
+            for job, e in failures:
+                print('Failed:', job[0], e)
+            print('Put down watermark size:', len(bwm1.wm_bit))
+
     if opts.work_mode == 'extract':
         if not len(args) == 1:
             print('Error! Usage: ')
@@ -45,6 +81,7 @@ def main():
 '''
 python -m blind_watermark.cli_tools --embed --pwd 1234 examples/pic/ori_img.jpeg "watermark text" examples/output/embedded.png
 python -m blind_watermark.cli_tools --extract --pwd 1234 --wm_shape 111 examples/output/embedded.png
+python -m blind_watermark.cli_tools --embed_batch --pwd 1234 --out_dir examples/output/batch "watermark text" examples/pic/ori_img.jpeg examples/pic/Lena_512x512.jpg
 
 
 cd examples
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 软判决：由奇异值对量化步长取模的余量得到每个分块的软值，按实测的可靠性加权，合成每一位的对数似然比（LLR）
+# 以及闭式的一维二分类阈值，one_dim_kmeans 用它代替迭代
+import numpy as np
+
+
+def soft_margin(s, d):
+    # 嵌入时 s mod d 被量化到 d/4（bit 0）或 3d/4（bit 1），返回 -sin(2π s / d)，在 [-1, 1] 之间：
+    # 正数倾向 1，负数倾向 0，绝对值越大离判决边界（s mod d 为 0 或 d/2）越远。符号与硬判决 s mod d > d/2 一致
+    return -np.sin(2 * np.pi / d * s)
+
+
+def otsu_threshold(values):
+    # 把一维数据分成两类，使类间方差最大，等价于 k=2 的 k-means 的全局最优解。
+    # 排序后用前缀和一次算出所有分割点的类间方差，不需要迭代。返回阈值，大于阈值的是一类
+    x = np.sort(np.ravel(values).astype(np.float64))
+    n = x.size
+    if n < 2 or x[0] == x[-1]:
+        return x[-1] if n else 0.0
+
+    k = np.arange(1, n)  # 最小的 k 个是一类
+    csum = np.cumsum(x)
+    mean0, mean1 = csum[:-1] / k, (csum[-1] - csum[:-1]) / (n - k)
+    between = k * (n - k) * (mean0 - mean1) ** 2
+    between[x[1:] == x[:-1]] = -1  # 相同的值不能分到两类
+    i = np.argmax(between)
+    return (x[i] + x[i + 1]) / 2
+
+
+def bit_stats(soft, wm_index, wm_size):
+    # 每一行软值在每一位上的个数、和、平方和，形状 (3, 行数, wm_size)，是 bit_llr 的充分统计量。
+    # soft 的形状是 (行数, block_num)。分条带、分段提取时各段的结果直接相加即可
+    soft = np.asarray(soft, dtype=np.float64).reshape(-1, len(wm_index))
+    count = np.bincount(wm_index, minlength=wm_size)
+    return np.array([[count, np.bincount(wm_index, weights=y, minlength=wm_size),
+                      np.bincount(wm_index, weights=y * y, minlength=wm_size)] for y in soft]).swapaxes(0, 1)
+
+
+def bit_llr(stats, iterations=2):
+    '''
+    由 bit_stats 合成每一位的对数似然比（LLR）。
+    每一行（一个 channel 的 s0 或 s1）看成二元信道 y = offset + mu * b + 噪声（b = ±1），
+    用判决反馈估计该行的 offset、mu 和噪声方差 sigma2，每个分块贡献 2 * mu / sigma2 * (y - offset) 的 LLR：
+    可靠的行权重大，整体偏向 0 或 1 的偏移（例如 JPEG 压缩后）被减掉，每个分块按离判决边界的远近计入。
+    第一次判决用各行等权的平均软值和 otsu_threshold，之后用上一次的 LLR 判决，共 iterations 次
+    返回 (llr, row_weights)，llr 长度 wm_size，正数表示 1
+    '''
+    count, total, total_sq = stats
+    wm_avg = total.sum(axis=0) / count.sum(axis=0)
+    bits = wm_avg > otsu_threshold(wm_avg)
+
+    for _ in range(iterations):
+        offsets, weights = np.zeros(len(total)), np.zeros(len(total))
+        for row in range(len(total)):
+            count1, count0 = count[row][bits].sum(), count[row][~bits].sum()
+            sum1, sum0 = total[row][bits].sum(), total[row][~bits].sum()
+            if count1 == 0 or count0 == 0:
+                # 只有一类时无法估计 offset，按 offset = 0 估计
+                mu = (sum1 - sum0) / (count1 + count0)
+                sigma2 = total_sq[row].sum() / (count1 + count0) - mu ** 2
+            else:
+                mean1, mean0 = sum1 / count1, sum0 / count0
+                offsets[row], mu = (mean1 + mean0) / 2, (mean1 - mean0) / 2
+                sigma2 = (total_sq[row].sum() - count1 * mean1 ** 2 - count0 * mean0 ** 2) / (count1 + count0)
+            # mu <= 0 的行与判决相反，不可靠，不参与
+            weights[row] = 2 * mu / max(sigma2, 1e-12) if mu > 0 else 0
+
+        llr = weights @ (total - offsets[:, np.newaxis] * count)
+        bits = llr > 0
+    return llr, weights
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 读写图片文件。.npy 文件以 memmap 方式打开，不需要把整张图解码到内存里，多个进程可以共享同一个只读输入
+import numpy as np
+import cv2
+
+
+def is_npy(filename):
+    return isinstance(filename, str) and filename.lower().endswith('.npy')
+
+
+def read_img_file(filename, flags=cv2.IMREAD_UNCHANGED):
+    # .npy 文件返回只读的 np.memmap，其它格式用 cv2.imread 解码
+    if is_npy(filename):
+        return np.load(filename, mmap_mode='r')
+    return cv2.imread(filename, flags=flags)
+
+
+def write_img_file(filename, img, params=None):
+    if is_npy(filename):
+        np.save(filename, img)
+        return True
+    if params is None:
+        return cv2.imwrite(filename=filename, img=img)
+    return cv2.imwrite(filename=filename, img=img, params=params)
+
+
+def create_img_file(filename, shape, dtype=np.uint8):
+    # 新建一个 .npy 文件，返回可写的 np.memmap，用于逐条带写出大图
+    assert is_npy(filename), 'only .npy is supported, got {filename}'.format(filename=filename)
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=tuple(shape))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 三段流水线：读图解码 -> 计算 -> 编码写图，三段各自用若干线程并行，互相重叠
+# OpenCV 的编解码和 numpy 的大部分计算都会释放 GIL，线程之间可以真正并行
+import queue
+import threading
+
+_DONE = object()  # 队列结束标记
+
+
+def run_pipeline(jobs, decode, compute, encode, decoders=2, workers=1, encoders=2, queue_size=8):
+    '''
+    :param jobs: 可迭代对象，逐个取出，不需要事先全部放进内存
+    :param decode: decode(job) -> data，在 decoders 个线程中运行
+    :param compute: compute(job, data) -> result，在 workers 个线程中运行
+    :param encode: encode(job, result)，在 encoders 个线程中运行
+    :param decoders, workers, encoders: 三段各自的线程数，都至少为 1，否则流水线会一直阻塞
+    :param queue_size: 段与段之间有界队列的长度。下游处理不过来时上游阻塞（背压），
+        内存中同时最多约 3 * queue_size + 线程数 个中间结果
+    :return: 处理失败的 [(job, exception)]，某个 job 出错不影响其它 job
+    '''
+    for name, num in (('decoders', decoders), ('workers', workers), ('encoders', encoders)):
+        if num < 1:
+            raise ValueError('{} should be at least 1, got {}'.format(name, num))
+
+    job_queue, decoded_queue, computed_queue = (queue.Queue(maxsize=queue_size) for _ in range(3))
+    failures = []
+
+    def feed():
+        try:
+            for job in jobs:
+                job_queue.put((job, None))
+        except Exception as e:
+            failures.append((None, e))
+        finally:
+            for _ in range(decoders):
+                job_queue.put(_DONE)
+
+    def stage(func, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            job, data = item
+            try:
+                result = func(job, data)
+            except Exception as e:
+                failures.append((job, e))
+                continue
+            if out_queue is not None:
+                out_queue.put((job, result))
+
+    stages = [(decoders, lambda job, _: decode(job), job_queue, decoded_queue),
+              (workers, compute, decoded_queue, computed_queue),
+              (encoders, encode, computed_queue, None)]
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    threads = [[threading.Thread(target=stage, args=(func, in_queue, out_queue), daemon=True) for _ in range(num)]
+               for num, func, in_queue, out_queue in stages]
+    for stage_threads in threads:
+        for thread in stage_threads:
+            thread.start()
+
+    # 上一段的线程全部结束后，再给下一段的每个线程发结束标记
+    feeder.join()
+    for (_, _, _, out_queue), stage_threads, next_num in zip(stages, threads, [workers, encoders, 0]):
+        for thread in stage_threads:
+            thread.join()
+        for _ in range(next_num):
+            out_queue.put(_DONE)
+    return failures
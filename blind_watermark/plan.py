@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 嵌入/提取计划：分块索引、每个分块的打乱顺序、每个分块嵌入水印的第几位
+# 只由图片分块数、block_shape、password_img、wm_size、shuffle_version、redundancy 决定，同样尺寸的图可以直接复用
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .cache import HostCache, cached_by
+
+# get_plan、shuffle_table、permutation_table 共用的内存缓存，按字节数限制，可以修改 max_bytes。
+# 计划中的 idx_shuffle 与 shuffle_table 的结果是同一个数组，会重复计入，实际占用的内存不超过上限
+default_plan_cache = HostCache(max_bytes=256 * 2 ** 20)
+
+
+class EmbedPlan(namedtuple('EmbedPlan', ['grid_shape', 'block_shape', 'password_img', 'wm_size', 'shuffle_version',
+                                         'redundancy', 'block_index', 'idx_shuffle', 'wm_index'])):
+    '''
+    不可变的嵌入/提取计划。
+    grid_shape: 分块的行数、列数
+    redundancy: 每一位最多嵌入几次，None 表示用上全部分块
+    block_index: (block_num, 2)，第 i 个分块的行号、列号，按行优先的顺序排列
+    idx_shuffle: (block_num, block_shape[0] * block_shape[1])，第 i 个分块 flatten 后的打乱顺序
+    wm_index: (block_num,)，第 i 个分块嵌入 wm_bit[wm_index[i]]
+    '''
+    __slots__ = ()
+
+    @property
+    def block_num(self):
+        # 嵌入水印的分块数
+        return len(self.block_index)
+
+    @property
+    def tile_index(self):
+        # 只用了部分分块时就是 block_index，用上全部分块时为 None，此时分块按行优先顺序直接 reshape，不需要索引
+        return None if self.block_num == self.grid_shape[0] * self.grid_shape[1] else self.block_index
+
+    def save(self, filename):
+        np.savez(filename, params=np.array(self.grid_shape + self.block_shape
+                                           + (self.password_img, self.wm_size, self.shuffle_version,
+                                              self.redundancy or 0)),
+                 block_index=self.block_index, idx_shuffle=self.idx_shuffle, wm_index=self.wm_index)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            params = [int(i) for i in f['params']]
+            # 旧版本保存的计划没有 redundancy
+            redundancy = params[7] if len(params) > 7 and params[7] else None
+            return cls(tuple(params[:2]), tuple(params[2:4]), params[4], params[5], params[6], redundancy,
+                       read_only(f['block_index']), read_only(f['idx_shuffle']), read_only(f['wm_index']))
+
+
+def read_only(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+def select_blocks(seed, block_num, size):
+    # 从 block_num 个分块中选出 size 个，返回升序的分块序号。
+    # 按行优先顺序把分块平均分成 size 段，每段中由 seed 随机选一个，选中的分块在整张图上均匀散开
+    start = np.arange(size, dtype=np.int64) * block_num // size
+    end = np.arange(1, size + 1, dtype=np.int64) * block_num // size
+    return start + (np.random.RandomState(seed).random(size) * (end - start)).astype(np.int64)
+
+
+def visit_rounds(plan, step_blocks=4096):
+    '''
+    渐进提取时访问分块的顺序，逐步产出分块序号的数组，每步约 step_blocks 个分块。
+    第 k 轮访问每一位的第 k 次嵌入，所以每一步每一位都能拿到新的提取结果。
+    各轮的先后（只用部分分块时还有每一位各次嵌入的先后）由 password_img 打乱，前几轮就散布在整张图上
+    '''
+    wm_size = max(plan.wm_size, 1)
+    rounds = max(step_blocks // wm_size, 1)  # 每步的轮数
+    random_state = np.random.RandomState(plan.password_img)
+    if plan.tile_index is None:
+        # 用上全部分块时 wm_index[i] = i % wm_size，第 r 轮就是分块 [r * wm_size, (r + 1) * wm_size)，不必排序
+        round_order = random_state.permutation(-(-plan.block_num // wm_size))
+        for start in range(0, round_order.size, rounds):
+            blocks = (round_order[start:start + rounds, np.newaxis] * wm_size + np.arange(wm_size)).ravel()
+            yield blocks[blocks < plan.block_num]
+        return
+
+    # 按打乱后的顺序，算出每个分块是它那一位的第几次嵌入，再按这个次数排序
+    order = random_state.permutation(plan.block_num)
+    wm_index = plan.wm_index[order]
+    by_bit = np.argsort(wm_index, kind='stable')
+    counts = np.bincount(wm_index, minlength=wm_size)
+    occurrence = np.empty(plan.block_num, dtype=np.int64)
+    occurrence[by_bit] = np.arange(plan.block_num) - np.repeat(np.cumsum(counts) - counts, counts)
+    order = order[np.argsort(occurrence, kind='stable')]
+    for start in range(0, plan.block_num, rounds * wm_size):
+        yield order[start:start + rounds * wm_size]
+
+
+def row_slice(block_index, row, row_end):
+    # block_index 按行优先排列，返回第 [row, row_end) 行分块在其中的切片
+    return slice(*np.searchsorted(block_index[:, 0], (row, row_end)))
+
+
+def random_strategy1(seed, size, block_shape):
+    return np.random.RandomState(seed) \
+        .random(size=(size, block_shape)) \
+        .argsort(axis=1)
+
+
+def random_strategy2(seed, size, block_shape):
+    one_line = np.random.RandomState(seed) \
+        .random(size=(1, block_shape)) \
+        .argsort(axis=1)
+
+    return np.repeat(one_line, repeats=size, axis=0)
+
+
+def random_strategy3(seed, size, block_shape, start=0, table_size=4096):
+    # random_strategy1 要生成 size * block_shape 个随机数再逐行 argsort。
+    # 这里只预先生成 table_size 个打乱顺序，第 i 个分块用哪一个由计数器型随机数 splitmix64(seed, i) 决定，
+    # 可以直接算出任意一段分块 [start, start + size) 的打乱顺序
+    table = permutation_table(seed, block_shape, table_size)
+    return table[splitmix64(seed, np.arange(start, start + size, dtype=np.uint64)) % np.uint64(table_size)]
+
+
+@cached_by(default_plan_cache)
+def permutation_table(seed, block_shape, table_size):
+    table = np.random.RandomState(seed).random(size=(table_size, block_shape)).argsort(axis=1)
+    return read_only(table.astype(np.uint8 if block_shape <= 256 else np.int32))
+
+
+def splitmix64(seed, counter):
+    # 计数器型随机数：对 (seed, counter) 做 splitmix64 哈希，uint64 溢出即取模
+    with np.errstate(over='ignore'):
+        z = counter + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+random_strategies = {1: random_strategy1, 2: random_strategy2, 3: random_strategy3}
+
+
+class ShuffleStream:
+    '''
+    按分块顺序一段一段地生成打乱顺序，拼起来与 random_strategies[shuffle_version](seed, block_num, block_shape) 相同。
+    用于分条带处理大图，不需要一次生成整张图所有分块的打乱顺序
+    '''
+
+    def __init__(self, seed, block_shape, shuffle_version=1):
+        self.seed, self.block_shape, self.shuffle_version = seed, block_shape, shuffle_version
+        self.start = 0
+        # RandomState 连续生成的随机数与一次生成的相同
+        self.random_state = np.random.RandomState(seed) if shuffle_version == 1 else None
+
+    def next(self, size):
+        if self.shuffle_version == 1:
+            idx_shuffle = self.random_state.random(size=(size, self.block_shape)).argsort(axis=1)
+        elif self.shuffle_version == 2:
+            idx_shuffle = random_strategy2(self.seed, size, self.block_shape)
+        else:
+            idx_shuffle = random_strategy3(self.seed, size, self.block_shape, start=self.start)
+        self.start += size
+        return idx_shuffle.astype(np.uint8 if self.block_shape <= 256 else np.int32)
+
+
+@cached_by(default_plan_cache)
+def shuffle_table(password_img, block_num, block_size, shuffle_version=1):
+    # 每个分块的打乱顺序，用占空间更小的类型保存
+    idx_shuffle = random_strategies[shuffle_version](password_img, block_num, block_size)
+    return read_only(idx_shuffle.astype(np.uint8 if block_size <= 256 else np.int32))
+
+
+@cached_by(default_plan_cache)
+def get_plan(grid_shape, block_shape, password_img, wm_size, shuffle_version=1, plan_dir=None, redundancy=None):
+    '''
+    带 LRU 缓存地生成 EmbedPlan，参数都要是可哈希的（tuple/int/str），缓存的总字节数上限见 default_plan_cache。
+    :param plan_dir: 若不为 None，先从这个目录读取保存过的计划，没有的话生成后存入该目录
+    :param redundancy: 若不为 None，每一位最多嵌入 redundancy 次，只用由 password_img 选出的
+        wm_size * redundancy 个分块，其余分块不改动
+    '''
+    grid_shape, block_shape = tuple(int(i) for i in grid_shape), tuple(int(i) for i in block_shape)
+    if plan_dir is not None:
+        filename = os.path.join(plan_dir, 'plan_{}x{}_{}x{}_{}_{}_v{}{}.npz'.format(
+            *grid_shape, *block_shape, password_img, wm_size, shuffle_version,
+            '' if redundancy is None else '_r{}'.format(redundancy)))
+        if os.path.exists(filename):
+            return EmbedPlan.load(filename)
+
+    block_num = grid_shape[0] * grid_shape[1]
+    if redundancy is not None and 0 < wm_size * redundancy < block_num:
+        block_num = wm_size * redundancy
+        block_index = np.stack(np.divmod(select_blocks(password_img, grid_shape[0] * grid_shape[1], block_num),
+                                         grid_shape[1]), axis=1).astype(np.int32)
+        # 每一位恰好嵌入 redundancy 次，由 password_img 打乱分给选中的分块。
+        # 若按顺序循环分配，同一位的各次嵌入间隔固定，可能正好落在同一列上，局部的攻击会集中影响某几位
+        wm_index = (np.random.RandomState(password_img).permutation(block_num) % wm_size).astype(np.int32)
+    else:
+        block_index = np.stack(np.divmod(np.arange(block_num, dtype=np.int32), grid_shape[1]), axis=1)
+        wm_index = np.arange(block_num, dtype=np.int32) % wm_size if wm_size else np.zeros(block_num, dtype=np.int32)
+
+    idx_shuffle = shuffle_table(password_img, block_num, block_shape[0] * block_shape[1], shuffle_version)
+    plan = EmbedPlan(grid_shape, block_shape, password_img, wm_size, shuffle_version, redundancy,
+                     read_only(block_index), idx_shuffle, read_only(wm_index))
+
+    if plan_dir is not None:
+        os.makedirs(plan_dir, exist_ok=True)
+        # 先写临时文件再改名，防止其它进程读到写了一半的文件
+        tmp_filename = filename + '.{pid}.tmp'.format(pid=os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            plan.save(f)
+        os.replace(tmp_filename, filename)
+    return plan
@@ -1,9 +1,73 @@
+import atexit
+import contextlib
+import os
 import sys
+import threading
 import multiprocessing
 import warnings
+from multiprocessing import shared_memory
 
-if sys.platform != 'win32':
-    multiprocessing.set_start_method('fork')
+import numpy as np
+import cv2
+
+# BLAS/OpenMP 读取的线程数环境变量，只对之后创建的进程生效
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def limit_threads(num_threads):
+    '''
+    限制本进程中 OpenCV 和 BLAS 的线程数，一直有效、不会恢复，用作进程池子进程的 initializer。
+    BLAS 的限制要装了 threadpoolctl 才能对已加载的库生效，否则只设置环境变量，对之后以 spawn 方式创建的子进程生效
+    '''
+    cv2.setNumThreads(num_threads)
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(num_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=num_threads)
+
+
+# thread_limits 的嵌套计数：同一进程中同时进行的调用里，第一个进入的保存原来的设置，最后一个退出的恢复
+_thread_limits_lock = threading.Lock()
+_thread_limits_state = {'depth': 0, 'num_threads': None, 'blas_limits': None}
+
+
+@contextlib.contextmanager
+def thread_limits(num_threads):
+    '''
+    只在 with 语句内把 OpenCV 和 BLAS 的线程数限制为 num_threads，不改环境变量。
+    这两个设置是整个进程共用的：多个线程同时在 with 语句内时，以最后进入的为准；
+    最先进入的保存原来的设置，全部退出后才恢复，所以并发调用结束后进程回到原来的设置。
+    BLAS 的限制要装了 threadpoolctl 才生效
+    '''
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+
+    state = _thread_limits_state
+    with _thread_limits_lock:
+        if state['depth'] == 0:
+            state['num_threads'] = cv2.getNumThreads()
+            # 第一次调用 threadpool_limits 时记下的原设置，最后由它恢复
+            state['blas_limits'] = None if threadpool_limits is None else threadpool_limits(limits=num_threads)
+        elif threadpool_limits is not None:
+            threadpool_limits(limits=num_threads)
+        cv2.setNumThreads(num_threads)
+        state['depth'] += 1
+    try:
+        yield
+    finally:
+        with _thread_limits_lock:
+            state['depth'] -= 1
+            if state['depth'] == 0:
+                cv2.setNumThreads(state['num_threads'])
+                if state['blas_limits'] is not None:
+                    state['blas_limits'].restore_original_limits()
+                state['num_threads'], state['blas_limits'] = None, None
 
 
 class CommonPool(object):
@@ -11,8 +75,78 @@ class CommonPool(object):
         return list(map(func, args))
 
 
+class PoolManager(object):
+    '''
+    进程内共享的进程池/线程池。某个 (mode, processes) 第一次用到时才创建，之后所有 WaterMark 复用同一个，
+    不会每次新建、也不会泄漏。可以用作 with 语句，退出时关闭；模块级的 default_pool_manager 在解释器退出时关闭。
+    :param start_method: 创建进程的方式，'fork'/'spawn'/'forkserver'，None 表示平台默认。
+        只影响这个 manager 创建的进程池，不修改全局的 multiprocessing.set_start_method
+    '''
+
+    def __init__(self, start_method=None):
+        self.start_method = start_method
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def get(self, mode, processes=None, worker_threads=None):
+        # worker_threads 不为 None 时，进程池的每个子进程启动时用 limit_threads 限制 OpenCV/BLAS 的线程数
+        with self.lock:
+            if self.pid != os.getpid():
+                # fork 出的子进程不能使用父进程的池，丢弃后重新创建
+                self.pools, self.pid = {}, os.getpid()
+
+            key = (mode, processes, worker_threads)
+            if key not in self.pools:
+                if mode == 'multithreading':
+                    from multiprocessing.pool import ThreadPool
+                    self.pools[key] = ThreadPool(processes=processes)
+                else:
+                    from multiprocessing import resource_tracker
+                    # 先启动 resource_tracker 再创建进程，子进程与主进程共用同一个，共享内存由主进程统一回收
+                    resource_tracker.ensure_running()
+                    initializer, initargs = (None, ()) if worker_threads is None else (limit_threads, (worker_threads,))
+                    self.pools[key] = multiprocessing.get_context(self.start_method).Pool(
+                        processes=processes, initializer=initializer, initargs=initargs)
+            return self.pools[key]
+
+    def close(self):
+        # 等待已提交的任务完成后关闭全部池，之后再用到时会重新创建
+        with self.lock:
+            pools, self.pools = self.pools, {}
+            if self.pid != os.getpid():
+                return
+        for pool in pools.values():
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+default_pool_manager = PoolManager()
+atexit.register(default_pool_manager.close)
+
+
 class AutoPool(object):
-    def __init__(self, mode, processes):
+    '''
+    :param executor: None，或任意 concurrent.futures.Executor / 有 map(func, iterable) 方法的对象。
+        不为 None 时忽略 mode，所有任务都交给 executor.map
+    :param chunk_size: 每个任务包含的分块数，向上取整到整行分块。None 表示按 processes 自动分段
+    :param cores_per_job: 处理一张图可以用的核数，None 表示不做限制。
+        由它统一决定池的大小（processes 为 None 时）和 OpenCV/BLAS 的线程数，避免几层线程叠加超额订阅：
+        并行度由线程池/进程池/executor 提供时，OpenCV/BLAS 只用 1 个线程，否则用 cores_per_job 个线程。
+        进程池的子进程启动时设置一次；其它模式只在每次嵌入/提取期间生效（见 thread_limits），全部调用结束后恢复原来的设置。
+        进程型的 executor 的子进程不在这里限制，可以在创建时传入 initializer=limit_threads, initargs=(1,)
+    '''
+
+    def __init__(self, mode, processes, pool_manager=None, executor=None, chunk_size=None, cores_per_job=None):
+
+        if executor is not None:
+            mode = 'executor'
 
         if mode == 'multiprocessing' and sys.platform == 'win32':
             warnings.warn('multiprocessing not support in windows, turning to multithreading')
@@ -20,19 +154,84 @@ class AutoPool(object):
 
         self.mode = mode
         self.processes = processes
+        self.pool_manager = pool_manager if pool_manager is not None else default_pool_manager
+        self.executor = executor
+        self.chunk_size = chunk_size
 
-        if mode == 'vectorization':
-            pass
-        elif mode == 'cached':
-            pass
-        elif mode == 'multithreading':
-            from multiprocessing.dummy import Pool as ThreadPool
-            self.pool = ThreadPool(processes=processes)
-        elif mode == 'multiprocessing':
-            from multiprocessing import Pool
-            self.pool = Pool(processes=processes)
+        # banded 为 True 时，按连续的若干行分块派发任务，而不是每个分块一个任务
+        self.banded = mode in ('multithreading', 'multiprocessing', 'executor')
+
+        self.cores_per_job = cores_per_job
+        self.worker_threads = None
+        if cores_per_job is not None:
+            if self.processes is None and mode in ('multithreading', 'multiprocessing'):
+                self.processes = cores_per_job
+            if mode == 'multiprocessing':
+                self.worker_threads = 1
+
+        if mode in ('vectorization', 'cached', 'multithreading', 'multiprocessing'):
+            # multithreading/multiprocessing 第一次 map 时才从 pool_manager 取得共享的线程池/进程池
+            self.pool = None
+        elif mode == 'executor':
+            self.pool = executor
         else:  # common
             self.pool = CommonPool()
 
     def map(self, func, args):
-        return self.pool.map(func, args)
+        if self.mode in ('multithreading', 'multiprocessing'):
+            return self.pool_manager.get(self.mode, self.processes, self.worker_threads).map(func, args)
+        # Executor.map 返回迭代器
+        return list(self.pool.map(func, args))
+
+    def thread_limits(self):
+        # 一次嵌入/提取期间 cores_per_job 对应的 OpenCV/BLAS 线程数限制，用于 with 语句
+        # multiprocessing 模式下计算都在子进程中，已由子进程的 initializer 限制
+        if self.cores_per_job is None or self.mode == 'multiprocessing':
+            return contextlib.nullcontext()
+        return thread_limits(1 if self.banded else self.cores_per_job)
+
+    def band_rows(self, grid_shape):
+        # 每个任务包含的分块行数
+        if self.chunk_size:
+            return max(-(-self.chunk_size // grid_shape[1]), 1)
+        # 默认每个进程分到 4 段左右，段数多于进程数可以让先做完的进程接着取下一段
+        band_num = 4 * (self.processes or os.cpu_count() or 1)
+        return max(-(-grid_shape[0] // band_num), 1)
+
+
+class SharedArray(object):
+    '''
+    放在共享内存（multiprocessing.shared_memory）里的 numpy.array。
+    pickle 时只传 name、shape、dtype，子进程反序列化后直接映射同一块内存，不复制数据。
+    同一批任务反序列化后共用一个对象，所以任务里不 close，子进程里的映射在对象被回收时关闭；创建者最后 unlink
+    '''
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+
+    @classmethod
+    def copy_from(cls, arr):
+        shared = cls(arr.shape, arr.dtype)
+        shared.ndarray()[...] = arr
+        return shared
+
+    def ndarray(self):
+        # 共享内存上的视图。close 之前要先释放所有视图
+        assert self.shm.buf is not None, 'shared memory {name} is closed'.format(name=self.shm.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __reduce__(self):
+        return self.__class__, (self.shape, self.dtype.str, self.shm.name)
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # 出错时 traceback 可能还引用着视图，这时交给垃圾回收释放
+            pass
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
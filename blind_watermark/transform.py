@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# 分块变换：把 haar 小波的 LL 子带与分块 dct 合并成一个固定的线性变换
+from functools import lru_cache
+
+import numpy as np
+
+
+def dct_matrix(n):
+    # cv2.dct 所用的正交 DCT-II 矩阵，对 n*n 分块有 dct(block) == C @ block @ C.T
+    k, x = np.ogrid[:n, :n]
+    mat = np.sqrt(2 / n) * np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+    mat[0, :] /= np.sqrt(2)
+    return mat
+
+
+def haar_ll_matrix(n, level=1):
+    # 一维 haar 小波做 level 层后 LL 部分对应的矩阵，形状 (n, n * 2 ** level)
+    # 每个低频系数是相邻 2 ** level 个像素之和乘以 2 ** (-level / 2)
+    step = 2 ** level
+    mat = np.zeros((n, n * step))
+    for i in range(n):
+        mat[i, i * step:(i + 1) * step] = 2 ** (-level / 2)
+    return mat
+
+
+def tile_view(plane, tile_shape):
+    # 不复制数据，把二维 plane 看成 (行数, 列数, tile_shape[0], tile_shape[1]) 的四维分块，
+    # 右边和下边不能整除的部分被忽略。写入这个视图会直接改写 plane
+    # plane 也可以有前导维度，例如 (图片数, H, W)，这些维度原样保留
+    height, width = plane.shape[-2:]
+    shape = plane.shape[:-2] + (height // tile_shape[0], width // tile_shape[1], tile_shape[0], tile_shape[1])
+    strides = plane.strides[:-2] + (plane.strides[-2] * tile_shape[0], plane.strides[-1] * tile_shape[1]) \
+        + plane.strides[-2:]
+    return np.lib.stride_tricks.as_strided(plane, shape, strides)
+
+
+class BlockTransform:
+    '''
+    像素分块 -> 分块 dct 系数 的线性变换。
+
+    haar 小波是正交变换，像素 tile 经过 dwt2 取 LL，再对 LL 的 block_shape 分块做 dct，
+    整个过程等价于 mat[0] @ tile @ mat[1].T，其中 mat[i] = dct_matrix @ haar_ll_matrix。
+    只改 LL（hvd 不变）时，idwt2 + idct 也等价于 mat[0].T @ delta @ mat[1]。
+    因此可以直接从 tile_shape = block_shape * 2 ** dwt_level 的像素分块得到 dct 系数，
+    并把系数的修改量直接变回像素的修改量，不需要对整张图做 dwt2/idwt2，也不需要 hvd。
+    dwt_level=0 时就是普通的分块 dct。
+    '''
+
+    def __init__(self, block_shape=(4, 4), dwt_level=1):
+        self.block_shape = tuple(int(i) for i in block_shape)
+        self.dwt_level = dwt_level
+        self.tile_shape = tuple(i * 2 ** dwt_level for i in self.block_shape)
+        self.mat = [(dct_matrix(n) @ haar_ll_matrix(n, dwt_level)).astype(np.float32) for n in self.block_shape]
+
+    def forward(self, tiles):
+        # tiles.shape = (..., tile_shape[0], tile_shape[1])  ->  (..., block_shape[0], block_shape[1])
+        return self.mat[0] @ tiles @ self.mat[1].T
+
+    def inverse(self, block_dct):
+        # forward 的转置，用于把 dct 系数的修改量变回像素的修改量
+        return self.mat[0].T @ block_dct @ self.mat[1]
+
+
+@lru_cache(maxsize=16)
+def get_block_transform(block_shape=(4, 4), dwt_level=1):
+    # 带缓存的 BlockTransform，block_shape 要是 tuple
+    return BlockTransform(block_shape, dwt_level)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+四通道的图：透明通道全是 255 的图（例如截图的 PNG）输出三通道图，有透明部分的图原样保留透明通道。
+channels 只用部分通道时也要能嵌入、提取
+"""
+import blind_watermark
+from blind_watermark import WaterMark
+import cv2
+import numpy as np
+import os
+
+blind_watermark.bw_notes.close()
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+ori_img = cv2.imread('pic/ori_img.jpeg', flags=cv2.IMREAD_COLOR)[:301, :455]
+wm = '@guofei9987 开源万岁！'
+
+opaque_img = cv2.cvtColor(ori_img, cv2.COLOR_BGR2BGRA)
+transparent_img = opaque_img.copy()
+transparent_img[:50, :50, 3] = 0
+
+for name, img in (('opaque', opaque_img), ('transparent', transparent_img)):
+    for channels in ((0,), (0, 1), (0, 1, 2)):
+        for mode in ('common', 'vectorization'):
+            bwm = WaterMark(password_img=1, password_wm=1, mode=mode, channels=channels)
+            bwm.read_img(img=img)
+            bwm.read_wm(wm, mode='str')
+            embed_img = bwm.embed()
+
+            if name == 'opaque':
+                assert embed_img.shape == ori_img.shape, '不透明的图应输出三通道图'
+            else:
+                assert np.array_equal(embed_img[:, :, 3], img[:, :, 3]), '透明通道应原样保留'
+
+            wm_extract = bwm.extract(embed_img=embed_img, wm_shape=len(bwm.wm_bit), mode='str')
+            assert wm_extract == wm, '提取水印和原水印不一致, {} {} {}'.format(name, channels, mode)
+        print(name, channels, 'ok')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+交叉解码：任何一种模式嵌入的图，都能用其它模式提取出水印，包括 JPEG 压缩之后。
+vectorization、cached、按分块行分段、memmap 分条带、extract_many 提取的软值要相同，
+并检查 extract_llr、extract_progressive
+"""
+import blind_watermark
+from blind_watermark import WaterMark
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import os
+import tempfile
+
+blind_watermark.bw_notes.close()
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+ori_img = cv2.imread('pic/ori_img.jpeg', flags=cv2.IMREAD_UNCHANGED)[:400, :400]
+wm = '@guofei9987 开源万岁！'
+wm_bit = np.array(list(bin(int(wm.encode('utf-8').hex(), base=16))[2:])) == '1'  # 未加密的水印
+wm_size = wm_bit.size
+
+
+def jpeg(img, quality=80):
+    return cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1], cv2.IMREAD_COLOR)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(2) as executor:
+        for params in (dict(), dict(redundancy=40)):
+            extractors = {mode: WaterMark(password_img=1, password_wm=1, mode=mode, processes=2, **params)
+                          for mode in ('common', 'vectorization', 'cached', 'multithreading', 'multiprocessing')}
+            extractors['executor'] = WaterMark(password_img=1, password_wm=1, executor=executor, **params)
+            bwm_vec = extractors['vectorization']
+
+            for embed_mode in ('common', 'vectorization', 'multithreading'):
+                bwm = WaterMark(password_img=1, password_wm=1, mode=embed_mode, processes=2, **params)
+                bwm.read_img(img=ori_img)
+                bwm.read_wm(wm, mode='str')
+                embed_img = bwm.embed()
+
+                for img in (embed_img, jpeg(embed_img)):
+                    for extract_mode, bwm1 in extractors.items():
+                        assert bwm1.extract(embed_img=img, wm_shape=wm_size, mode='str') == wm, \
+                            '{} 嵌入、{} 提取失败, {}'.format(embed_mode, extract_mode, params)
+
+                    # 软判决：各种模式的 LLR 相同，符号就是水印的每一位
+                    llr = bwm_vec.extract_llr(embed_img=img, wm_shape=wm_size)
+                    assert np.array_equal(llr > 0, wm_bit), 'extract_llr 失败, {}'.format(params)
+                    for mode in ('cached', 'multithreading', 'multiprocessing', 'executor'):
+                        assert np.allclose(extractors[mode].extract_llr(embed_img=img, wm_shape=wm_size), llr), \
+                            '{} 与 vectorization 的 LLR 不一致, {}'.format(mode, params)
+                    # .npy 文件以 memmap 方式打开，分条带提取
+                    filename = os.path.join(tmp_dir, 'embedded.npy')
+                    np.save(filename, img)
+                    assert np.allclose(bwm_vec.extract_llr(filename=filename, wm_shape=wm_size), llr), \
+                        'memmap 与 vectorization 的 LLR 不一致, {}'.format(params)
+
+                    # 硬判决的平均值：vectorization 与分段、分条带、成批提取相同
+                    wm_avg = bwm_vec.bwm_core.extract(img=img, wm_shape=wm_size)
+                    for mode in ('cached', 'multithreading', 'multiprocessing', 'executor'):
+                        assert np.allclose(extractors[mode].bwm_core.extract(img=img, wm_shape=wm_size), wm_avg), \
+                            '{} 与 vectorization 的提取结果不一致, {}'.format(mode, params)
+                    assert np.allclose(bwm_vec.bwm_core.extract_tiled(img, wm_size, strip_height=100), wm_avg), \
+                        'extract_tiled 与 vectorization 的提取结果不一致, {}'.format(params)
+                    assert bwm_vec.extract_many([img, img], wm_shape=wm_size, mode='str') == [wm, wm], \
+                        'extract_many 失败, {}'.format(params)
+
+                    # 渐进提取：提前结束时也要提取正确，访问完全部分块时与 vectorization 相同
+                    wm_extract, _ = bwm_vec.extract_progressive(embed_img=img, wm_shape=wm_size, mode='str')
+                    assert wm_extract == wm, 'extract_progressive 失败, {}'.format(params)
+                    wm_avg_all, _ = bwm_vec.bwm_core.extract_progressive(img, wm_size, confidence=2)
+                    assert np.allclose(wm_avg_all, wm_avg), \
+                        'extract_progressive 与 vectorization 的提取结果不一致, {}'.format(params)
+
+                print(embed_mode, params, 'cross-mode decoding ok')
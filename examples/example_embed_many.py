@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同一张图嵌入多个水印（例如每个接收者一个），embed_many 的结果要与逐个 read_wm + embed 相同。
+包括 redundancy 不为 None、各水印长度不同的情况
+"""
+import blind_watermark
+from blind_watermark import WaterMark
+import cv2
+import numpy as np
+import os
+
+blind_watermark.bw_notes.close()
+
+os.chdir(os.path.dirname(__file__))
+ori_img = cv2.imread('pic/ori_img.jpeg', flags=cv2.IMREAD_UNCHANGED)
+wms = ['user 1', 'user 22', 'a longer user name 333', 'user 1']
+
+for mode in ('vectorization', 'cached'):
+    for redundancy in (None, 8):
+        bwm = WaterMark(password_img=1, password_wm=1, mode=mode, redundancy=redundancy)
+        embed_imgs = list(bwm.embed_many(wms, mode='str', img=ori_img))
+
+        for wm, embed_img in zip(wms, embed_imgs):
+            bwm1 = WaterMark(password_img=1, password_wm=1, mode=mode, redundancy=redundancy)
+            bwm1.read_img(img=ori_img)
+            bwm1.read_wm(wm, mode='str')
+            assert np.array_equal(embed_img, bwm1.embed()), 'embed_many 与逐个 embed 的结果不一致'
+
+            wm_extract = bwm1.extract(embed_img=embed_img, wm_shape=len(bwm1.wm_bit), mode='str')
+            assert wm == wm_extract, '提取水印和原水印不一致'
+        print(mode, redundancy, 'embed_many ok')
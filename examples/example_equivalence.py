@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+各种嵌入方式的结果要与 vectorization 模式逐像素相同：
+cached、multithreading/multiprocessing/executor 按分块行分段、embed_tiled 对 memmap 分条带、embed_many，
+包括 redundancy、dwt_level、block_shape、shuffle_version 不是默认值的情况
+"""
+import blind_watermark
+from blind_watermark import WaterMark, HostCache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import cv2
+import numpy as np
+import os
+import tempfile
+
+blind_watermark.bw_notes.close()
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+ori_img = cv2.imread('pic/ori_img.jpeg', flags=cv2.IMREAD_UNCHANGED)
+wms = ['@guofei9987 开源万岁！', 'user 1']
+params_list = [dict(),
+               dict(redundancy=8),
+               dict(dwt_level=2, block_shape=(4, 8), shuffle_version=3)]
+
+
+def embed(wm, **kwargs):
+    bwm = WaterMark(password_img=1, password_wm=1, **kwargs)
+    bwm.read_img(img=ori_img)
+    bwm.read_wm(wm, mode='str')
+    return bwm.embed()
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ThreadPoolExecutor(2) as thread_executor, ProcessPoolExecutor(2) as process_executor:
+        for params in params_list:
+            expected = embed(wms[0], mode='vectorization', **params)
+
+            # 各种模式的整图嵌入
+            # 第二个 HostCache 从第一个写入 spill_dir 的文件中读回分解结果
+            spill_dir = os.path.join(tmp_dir, 'cache')
+            for name, kwargs in [('cached', dict(mode='cached')),
+                                 ('cached spill write', dict(mode='cached', cache=HostCache(spill_dir=spill_dir))),
+                                 ('cached spill read', dict(mode='cached', cache=HostCache(spill_dir=spill_dir))),
+                                 ('multithreading', dict(mode='multithreading', processes=2, chunk_size=1)),
+                                 ('multiprocessing', dict(mode='multiprocessing', processes=2)),
+                                 ('thread executor', dict(executor=thread_executor, chunk_size=1000)),
+                                 ('process executor', dict(executor=process_executor)),
+                                 ('cores_per_job', dict(mode='vectorization', cores_per_job=1))]:
+                assert np.array_equal(embed(wms[0], **kwargs, **params), expected), \
+                    '{} 与 vectorization 的结果不一致, {}'.format(name, params)
+
+            # 分条带嵌入 memmap，strip_height 不是分块高度的整数倍，图的高度也不是条带的整数倍
+            src = np.lib.format.open_memmap(os.path.join(tmp_dir, 'src.npy'), mode='w+', dtype=np.uint8,
+                                            shape=ori_img.shape)
+            src[:] = ori_img
+            bwm = WaterMark(password_img=1, password_wm=1, **params)
+            bwm.read_wm(wms[0], mode='str')
+            dst = bwm.embed_tiled(src, os.path.join(tmp_dir, 'dst.npy'), strip_height=100)
+            assert np.array_equal(dst, expected), 'embed_tiled 与 vectorization 的结果不一致, {}'.format(params)
+            del src, dst
+
+            # embed_many 与逐个 embed 相同
+            for mode in ('vectorization', 'cached'):
+                bwm = WaterMark(password_img=1, password_wm=1, mode=mode, **params)
+                for wm, embed_img in zip(wms, bwm.embed_many(wms, mode='str', img=ori_img)):
+                    assert np.array_equal(embed_img, embed(wm, mode='vectorization', **params)), \
+                        'embed_many 与逐个 embed 的结果不一致, {}'.format(params)
+
+            print(params, 'embed equivalence ok')
@@ -19,7 +19,7 @@ def read_requirements(filename):
 
 
 setup(name='blind_watermark',
-      python_requires='>=3.5',
+      python_requires='>=3.8',
       version=blind_watermark.__version__,
       description='Blind Watermark in Python',
       long_description=read_file('docs/en/README.md'),